@@ -1,22 +1,30 @@
+import hashlib
+import io
 import os
 import re
 import sys
 import time
+from collections import deque
 from datetime import datetime
-from difflib import SequenceMatcher
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 
 # === CONFIGURATION ===
 PRIMARY_MODEL = "mistral:7b-instruct"
 FALLBACK_MODEL = "codellama:13b-instruct-q4_K_M"
 TIMEOUT = 120
-CHUNK_SIZE = 90
-CHUNK_OVERLAP = 30
-FUZZY_THRESHOLD = 0.94
+CHUNK_SIZE = 200
+CHUNK_OVERLAP = 20
+FUZZY_THRESHOLD = 0.94  # Jaccard similarity of token n-grams above which two use cases are duplicates
+NGRAM_SIZE = 3
 TEMPLATE_FILE = "use_case_template.md"
 OUTPUT_BASE = "use_case_outputs"
 INCLUDE_AP200 = False
+# Files processed concurrently by --all; keep at or below the Ollama server's OLLAMA_NUM_PARALLEL
+OLLAMA_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "2"))
 
 # === ALL FILES TO PROCESS ===
 ALL_RPG_FILES = [
@@ -28,22 +36,46 @@ ALL_RPG_FILES = [
 ]
 SOURCE_DIR = r"C:\Temp\IBM-GitHub-Submission-Unedited\IBM-GitHub-Submission\QSRC"
 
-def read_lines(path):
+USE_CASE_ID_RE = re.compile(r"UC-AP-\d+-\d+")
+NARRATIVE_HEADERS = ["Identification", "Description", "Pre-Condition", "Post-Condition",
+                     "Entities Used / Tables Used", "Program Steps", "Tests Needed"]
+_NUMBERING_RE = re.compile(r"^\s*(?:\d+[.)]|[-*])\s+", re.MULTILINE)
+_WHITESPACE_RE = re.compile(r"\s+")
+# Any narrative header, so one scan finds where each one first appears
+_SECTION_RE = re.compile(r"##+\s+(" + "|".join(re.escape(h) for h in NARRATIVE_HEADERS) + ")")
+
+def iter_lines(path):
     with open(path, "r", encoding="utf-8") as f:
-        return [line.rstrip("\n") for line in f.readlines()]
+        for line in f:
+            yield line.rstrip("\n")
 
 def chunk_lines(lines, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    # Sliding window over any line iterable; yields the same chunks as slicing lines[i:i + size] every step
     step = size - overlap
-    return ['\n'.join(lines[i:i + size]) for i in range(0, len(lines), step)]
+    window = deque(maxlen=size)
+    count = 0
+    for line in lines:
+        window.append(line)
+        count += 1
+        start = count - size
+        if start >= 0 and start % step == 0:
+            yield '\n'.join(window)
+    # Flush the shorter windows that start before EOF but run past it
+    first = 0 if count < size else (count - size) // step * step + step
+    tail = list(window)
+    offset = count - len(tail)
+    for start in range(first, count, step):
+        yield '\n'.join(tail[start - offset:])
 
-def build_prompt(template, chunk, context=None, program="XXX"):
+def build_prompt(template, chunk, context=None, program="XXX", last_ids=None):
     context_block = f"\nReference context from AP200 (not primary logic):\n{context}\n" if context else ""
+    carryover = f"\nPreviously extracted IDs: {', '.join(last_ids)} (do not repeat these use cases)\n" if last_ids else ""
     return f"""{template}
 You are analyzing IBM RPG code from program AP{program}.
 Only extract meaningful business logic use cases — voucher handling, GL, invoice, check processing, 1099s.
 
 Return ONLY structured output. Follow the format. No commentary.
-{context_block}
+{context_block}{carryover}
 [RPG CODE]
 {chunk}
 [END CODE]
@@ -62,6 +94,9 @@ def run_ollama(model, prompt):
     except subprocess.TimeoutExpired:
         return None
 
+def extract_use_case_ids(text):
+    return list(dict.fromkeys(USE_CASE_ID_RE.findall(text)))
+
 def normalize_headers(text, program):
     replacements = {
         "## Input Validation": "## Input Type Validation Checks",
@@ -84,41 +119,95 @@ def extract_title(text, program):
     clean_title = re.sub(r'[^a-zA-Z0-9\- ]+', '', title).replace(' ', '-')
     return f"UC-AP-{program}-{id_part}-{clean_title[:75]}"
 
+def append_paragraph(body, text, style_id=None):
+    # Build <w:p> directly instead of going through doc.add_paragraph's style lookup
+    p = OxmlElement("w:p")
+    if style_id:
+        p_pr = OxmlElement("w:pPr")
+        p_style = OxmlElement("w:pStyle")
+        p_style.set(qn("w:val"), style_id)
+        p_pr.append(p_style)
+        p.append(p_pr)
+    if text:
+        r = OxmlElement("w:r")
+        t = OxmlElement("w:t")
+        t.set(qn("xml:space"), "preserve")
+        t.text = text
+        r.append(t)
+        p.append(r)
+    # Paragraphs must stay ahead of the trailing section properties
+    if body.sectPr is not None:
+        body.sectPr.addprevious(p)
+    else:
+        body.append(p)
+
 def save_as_docx(content, path):
     doc = Document()
+    body = doc.element.body
     for line in content.splitlines():
         if line.startswith("### "):
-            doc.add_paragraph(line[4:], style='Heading2')
+            append_paragraph(body, line[4:], "Heading2")
         elif line.startswith("**") and line.endswith("**"):
-            doc.add_paragraph(line.strip("*"), style='Heading3')
+            append_paragraph(body, line.strip("*"), "Heading3")
         else:
-            doc.add_paragraph(line)
+            append_paragraph(body, line)
     doc.save(path)
 
+def canon(text):
+    # Lowercase, drop list/step numbering and collapse whitespace so trivially reformatted outputs collide
+    return _WHITESPACE_RE.sub(" ", _NUMBERING_RE.sub("", text)).strip().lower()
+
+def ngrams(text, n=NGRAM_SIZE):
+    toks = text.split()
+    return {tuple(toks[i:i + n]) for i in range(len(toks) - n + 1)}
+
+def is_fuzzy_duplicate(grams, seen_grams):
+    for g in seen_grams:
+        # |A & B| / |A | B| can never exceed min/max of the set sizes, so skip pairs that can't reach the threshold
+        if not grams or not g or min(len(grams), len(g)) / max(len(grams), len(g)) <= FUZZY_THRESHOLD:
+            continue
+        if len(grams & g) / len(grams | g) > FUZZY_THRESHOLD:
+            return True
+    return False
+
 def fuzzy_dedupe(results):
-    seen, unique = [], []
+    # Exact duplicates of the canonical text are dropped by hash; only survivors get the n-gram comparison
+    exact, seen_grams, unique = {}, [], []
     for r in results:
-        if not any(SequenceMatcher(None, r, s).ratio() > FUZZY_THRESHOLD for s in seen):
-            seen.append(r)
+        text = canon(r)
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        if key in exact:
+            continue
+        exact[key] = r
+        grams = ngrams(text)
+        if not is_fuzzy_duplicate(grams, seen_grams):
+            seen_grams.append(grams)
             unique.append(r)
     return unique
 
 def format_narrative(text):
-    headers = ["Identification", "Description", "Pre-Condition", "Post-Condition",
-               "Entities Used / Tables Used", "Program Steps", "Tests Needed"]
+    # Where each header's first occurrence ends, from a single scan
+    found = {}
+    for m in _SECTION_RE.finditer(text):
+        found.setdefault(m.group(1), m.end())
+
     result = ["Use Case Template\n"]
-    for h in headers:
-        m = re.search(f"##+\s+{re.escape(h)}(.*?)(?=\n## |$)", text, re.DOTALL)
-        if m:
-            result.append(f"### {h}\n{m.group(1).strip()}\n")
+    for h in NARRATIVE_HEADERS:
+        if h in found:
+            # The section runs up to the next "## " heading; "### " sub-headings stay inside it
+            start = found[h]
+            end = text.find("\n## ", start)
+            result.append(f"### {h}\n{(text[start:end] if end >= 0 else text[start:]).strip()}\n")
     return "\n".join(result)
 
 def process_chunks(file_path, program):
     now = datetime.now()
     date_folder = os.path.join(OUTPUT_BASE, f"usecases-{now.strftime('%Y-%m-%d')}")
     timestamp = now.strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join(date_folder, f"{program}_{timestamp}")
-    log_dir = os.path.join("logs", f"logs_{program}_{timestamp}")
+    # Named after the source file, since AP760/AP760P (and others) share a program number and may run together
+    source = os.path.basename(file_path).split(".")[0]
+    output_dir = os.path.join(date_folder, f"{source}_{timestamp}")
+    log_dir = os.path.join("logs", f"logs_{source}_{timestamp}")
     low_conf_dir = os.path.join(output_dir, "LOW_CONFIDENCE")
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(log_dir, exist_ok=True)
@@ -129,22 +218,24 @@ def process_chunks(file_path, program):
     low_conf_docx = os.path.join(output_dir, "LOW_CONFIDENCE.docx")
     failed_txt = os.path.join(output_dir, "FAILED_CHUNKS.txt")
 
-    all_lines = read_lines(file_path)
-    ap200_lines = read_lines(os.path.join(SOURCE_DIR, "AP200.rpg36.txt")) if INCLUDE_AP200 else []
+    ap200_context = "\n".join(iter_lines(os.path.join(SOURCE_DIR, "AP200.rpg36.txt"))) if INCLUDE_AP200 else ""
     template = open(TEMPLATE_FILE, "r", encoding="utf-8").read()
-    chunks = chunk_lines(all_lines)
+    chunks = chunk_lines(iter_lines(file_path))
 
     all_results = []
     low_conf_results = []
     failed = []
-    raw_log = []
+    raw_log_buf = io.BytesIO()
+    last_ids = []
 
     for i, chunk in enumerate(chunks):
-        prompt = build_prompt(template, chunk, "\n".join(ap200_lines), program)
+        prompt = build_prompt(template, chunk, ap200_context, program, last_ids)
         result = run_ollama(PRIMARY_MODEL, prompt) or run_ollama(FALLBACK_MODEL, prompt)
         if result:
             result = normalize_headers(result, program)
-            raw_log.append(f"\n\n# Chunk {i + 1}\n{result}\n{'=' * 50}\n")
+            # Carry forward only the IDs, not the overlapping source lines
+            last_ids = extract_use_case_ids(result)
+            raw_log_buf.write(f"\n\n# Chunk {i + 1}\n{result}\n{'=' * 50}\n".encode("utf-8"))
             if is_valid_output(result):
                 filename = extract_title(result, program)
                 md_path = os.path.join(output_dir, f"{filename}.md")
@@ -159,12 +250,14 @@ def process_chunks(file_path, program):
         else:
             failed.append(i + 1)
 
-    with open(raw_out, "w", encoding="utf-8") as f:
-        f.writelines(raw_log)
+    with open(raw_out, "wb") as f:
+        f.write(raw_log_buf.getvalue())
 
-    with open(summary_md, "w", encoding="utf-8") as f:
-        for uc in fuzzy_dedupe(all_results):
-            f.write(format_narrative(uc) + "\n\n" + "=" * 60 + "\n\n")
+    summary_buf = io.BytesIO()
+    for uc in fuzzy_dedupe(all_results):
+        summary_buf.write((format_narrative(uc) + "\n\n" + "=" * 60 + "\n\n").encode("utf-8"))
+    with open(summary_md, "wb") as f:
+        f.write(summary_buf.getvalue())
 
     with open(failed_txt, "w") as f:
         for idx in failed:
@@ -172,22 +265,27 @@ def process_chunks(file_path, program):
 
     if low_conf_results:
         doc = Document()
+        body = doc.element.body
         for r in low_conf_results:
-            doc.add_paragraph("========================================", style='Heading2')
+            append_paragraph(body, "========================================", "Heading2")
             for line in r.splitlines():
-                doc.add_paragraph(line)
+                append_paragraph(body, line)
         doc.save(low_conf_docx)
 
     print(f"✅ Done: {len(all_results)} strong use cases, {len(low_conf_results)} low confidence, {len(failed)} failed.")
 
+def process_file_by_name(fname):
+    full_path = os.path.join(SOURCE_DIR, fname)
+    program_match = re.search(r"AP(\d+)", fname.upper())
+    if not program_match:
+        print(f"Skipping {fname}: No AP### match.")
+        return
+    process_chunks(full_path, program_match.group(1))
+
 def run_all():
-    for fname in ALL_RPG_FILES:
-        full_path = os.path.join(SOURCE_DIR, fname)
-        program_match = re.search(r"AP(\d+)", fname.upper())
-        if not program_match:
-            print(f"Skipping {fname}: No AP### match.")
-            continue
-        process_chunks(full_path, program_match.group(1))
+    # Files share nothing but the template and the Ollama server, so fan them out
+    with ProcessPoolExecutor(max_workers=OLLAMA_PARALLEL) as ex:
+        list(ex.map(process_file_by_name, ALL_RPG_FILES))
 
 if __name__ == "__main__":
     if "--all" in sys.argv:
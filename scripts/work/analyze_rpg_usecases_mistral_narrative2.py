@@ -1,19 +1,72 @@
+import asyncio
+import atexit
+import hashlib
+import itertools
+import json
+import logging
+import logging.handlers
 import os
-import subprocess
+import queue
+import shelve
+import sys
 import time
 from datetime import datetime
 from difflib import SequenceMatcher
+from pathlib import Path
 import re
 
+import httpx
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # pip install faiss-cpu; numpy matmul is used for every cache size
+    faiss = None
+
+try:
+    from datasketch import MinHash, MinHashLSH
+except ImportError:  # pip install datasketch; without it every pair goes through SequenceMatcher
+    MinHash = MinHashLSH = None
+
+try:
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:  # pip install rapidfuzz; falls back to difflib
+    fuzz = fuzz_process = None
+
 # === CONFIGURATION ===
 PRIMARY_MODEL = "mistral:7b-instruct-q4_K_M"
 FALLBACK_MODEL = "codellama:13b-instruct-q4_K_M"
 CHUNK_SIZE = 90
 CHUNK_OVERLAP = 30
+USE_LOGICAL_CHUNKS = True  # Cut chunks at BEGSR/ENDSR (DCL-PROC/END-PROC) boundaries; False = fixed sliding windows
 TIMEOUT = 120
 DEBUG = True
 ALLOW_FLOWCHART = True
 
+OLLAMA_URL = "http://localhost:11434"
+OLLAMA_KEEP_ALIVE = "30m"  # Keep the model resident between chunks instead of reloading it
+OLLAMA_NUM_CTX = 8192  # Fixed context size; changing it between requests invalidates the cached prompt prefix
+# Chunks sent to Ollama at once. The server only runs them in parallel if it was started with
+# OLLAMA_NUM_PARALLEL set to at least this value (and OLLAMA_MAX_LOADED_MODELS=2 so the
+# fallback model can stay loaded next to the primary); otherwise requests queue server-side.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# Output is streamed; a response with no section header by STREAM_ABORT_AFTER tokens is abandoned
+STREAM_CHECK_EVERY = 200
+STREAM_ABORT_AFTER = 512
+
+# Overlapping windows often repeat the same code, so results are reused for identical
+# (exact hash) or near-identical (embedding cosine) chunks, across runs as well. Entries are
+# tied to the prompt and models that produced them, so editing either starts a fresh cache
+SEMANTIC_CACHE = True
+SEMANTIC_CACHE_FILE = "semantic_cache.json"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+EMBED_MODEL = "nomic-embed-text"
+# Every successful (model, prompt) response is kept on disk so unchanged chunks are free on rerun.
+# The key is the model and full prompt, so a changed STRUCTURED_FORMAT or prompt wording simply misses.
+LLM_CACHE_FILE = ".llm_cache.db"
+EMBED_BATCH_SIZE = 128  # Chunks per /api/embed request
+FAISS_MIN_ENTRIES = 10000  # Above this many cached embeddings, search a FAISS index instead of a plain matmul
+
 SOURCE_FILES = [
     r"C:\Temp\IBM-GitHub-Submission-Unedited\IBM-GitHub-Submission\QSRC\AP160.rpg36.txt",
     r"C:\Temp\IBM-GitHub-Submission-Unedited\IBM-GitHub-Submission\QSRC\AP200.rpg36.txt"
@@ -21,6 +74,18 @@ SOURCE_FILES = [
 USE_CASE_TEMPLATE_FILE = "use_case_template.md"
 OUTPUT_BASE = "use_case_outputs"
 FUZZY_SIMILARITY_THRESHOLD = 0.94
+MINHASH_NUM_PERM = 128
+# Jaccard on word bigrams; only LSH candidates get the full ratio check. Pairs above
+# FUZZY_SIMILARITY_THRESHOLD have bigram Jaccard of ~0.75 or more, so 0.5 keeps LSH from missing them
+MINHASH_LSH_THRESHOLD = 0.5
+
+# Coroutines only enqueue log records; a listener thread does the actual (blocking) stdout writes
+log = logging.getLogger("mistral_narrative")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
 
 STRUCTURED_FORMAT = """
 Respond using the following structure and labels. Fill in all applicable sections. Always include a flowchart if one can be derived from the logic.
@@ -72,18 +137,45 @@ Provide a flowchart or process diagram if possible using code block formatting.
 """
 
 def read_lines(path):
-    with open(path, "r") as f:
-        return [line.rstrip("\n") for line in f.readlines()]
+    return Path(path).read_text(encoding="utf-8", errors="replace").splitlines()
 
 def sliding_chunks(lines, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
-    step = size - overlap
-    return ['\n'.join(lines[i:i+size]) for i in range(0, len(lines), step) if i + size <= len(lines)]
-
-def is_similar_to_template(chunk, template_lines):
-    return any(line.strip() in template_lines for line in chunk.splitlines())
-
-def build_prompt(rpg_code):
-    return f"""
+    # Join once and slice each window out of the joined text instead of re-joining overlapping lines
+    text = "\n".join(lines)
+    offsets = [0] + list(itertools.accumulate(len(line) + 1 for line in lines))
+    for i in range(0, len(lines) - size + 1, size - overlap):
+        yield text[offsets[i]:offsets[i+size] - 1]
+
+_SUBR_START_RE = re.compile(r"\b(?:BEGSR|DCL-PROC)\b", re.IGNORECASE)
+_SUBR_END_RE = re.compile(r"\b(?:ENDSR|END-PROC)\b", re.IGNORECASE)
+
+def logical_chunks(lines, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    # Once a chunk has `size` lines it ends at the next subroutine/procedure boundary, so
+    # subroutines stay whole; anything still unbroken at 2*size is cut with `overlap` lines carried over
+    current = []
+    fresh = 0  # lines in `current` that weren't carried over from the previous chunk
+    for line in lines:
+        if len(current) >= size and _SUBR_START_RE.search(line):
+            yield "\n".join(current)
+            current, fresh = [], 0
+        current.append(line)
+        fresh += 1
+        if len(current) >= size and _SUBR_END_RE.search(line):
+            yield "\n".join(current)
+            current, fresh = [], 0
+        elif len(current) >= size * 2:
+            yield "\n".join(current)
+            current = current[-overlap:] if overlap else []
+            fresh = 0
+    if fresh:
+        yield "\n".join(current)
+
+def is_similar_to_template(chunk, template_set):
+    return any(line.strip() in template_set for line in chunk.splitlines())
+
+# Everything ahead of the RPG code is identical for every chunk, so Ollama can reuse
+# the KV cache for this prefix and only prefill the code that changes
+_PROMPT_PREFIX = f"""
 You are analyzing legacy IBM RPG code to extract a structured business use case.
 
 Focus on logic related to:
@@ -108,57 +200,140 @@ Use this format:
 {STRUCTURED_FORMAT}
 
 [RPG CODE]
-{rpg_code}
-[END CODE]
 """
+_PROMPT_SUFFIX = "\n[END CODE]\n"
+
+def build_prompt(rpg_code):
+    return _PROMPT_PREFIX + rpg_code + _PROMPT_SUFFIX
+
+_EARLY_MARKERS = ("## Identification", "## Description")
+_MARKER_TAIL = max(len(marker) for marker in _EARLY_MARKERS) - 1
+
+_llm_cache = None  # shelve opened by MAIN
+
+async def run_ollama(client, model, prompt, retries=2, delay=5):
+    if _llm_cache is None:
+        return await generate(client, model, prompt, retries, delay)
+    key = hashlib.sha256((model + "\0" + prompt).encode("utf-8")).hexdigest()
+    cached = _llm_cache.get(key)
+    if cached is not None:
+        log.info(f"💾 Using cached response from {model}")
+        return cached
+    result = await generate(client, model, prompt, retries, delay)
+    if result:
+        _llm_cache[key] = result
+    return result
 
-def run_ollama(model, prompt, retries=2, delay=5):
+async def generate(client, model, prompt, retries=2, delay=5):
     for attempt in range(retries):
         try:
-            print(f"🤖 Running model: {model} (Attempt {attempt + 1})")
-            result = subprocess.run(
-                ["ollama", "run", model],
-                input=prompt.encode(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=TIMEOUT
-            )
-            return result.stdout.decode().strip()
-        except subprocess.TimeoutExpired:
-            print(f"⏱️ Timeout on {model}, attempt {attempt + 1}. Retrying in {delay}s...")
-            time.sleep(delay)
+            log.info(f"🤖 Running model: {model} (Attempt {attempt + 1})")
+            # The client timeout only limits the gap between streamed lines; this bounds the whole generation
+            return await asyncio.wait_for(stream_generation(client, model, prompt), TIMEOUT)
+        except (httpx.TimeoutException, asyncio.TimeoutError):
+            log.info(f"⏱️ Timeout on {model}, attempt {attempt + 1}. Retrying in {delay}s...")
+            await asyncio.sleep(delay)
+        except httpx.HTTPError as e:
+            log.info(f"❌ Ollama request failed for {model}: {e}")
+            return None
+        except json.JSONDecodeError as e:
+            log.info(f"❌ Malformed stream line from {model}: {e}")
+            return None
     return None
 
-def has_flowchart(text):
-    return "## Flowchart" in text or ("```" in text and "Process" in text)
+async def stream_generation(client, model, prompt):
+    parts = []
+    recent = []  # fragments not yet searched for markers
+    tail = ""  # end of the already-searched text, in case a marker spans two checks
+    tokens = 0
+    structured = False
+    async with client.stream("POST", "/api/generate", json={
+        "model": model, "prompt": prompt, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_ctx": OLLAMA_NUM_CTX}
+    }) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if "error" in data:
+                log.info(f"❌ Ollama error from {model}: {data['error']}")
+                return None
+            fragment = data.get("response", "")
+            parts.append(fragment)
+            tokens += 1
+            if not structured:
+                recent.append(fragment)
+            if not structured and (tokens % STREAM_CHECK_EVERY == 0 or tokens == STREAM_ABORT_AFTER):
+                # Only the fragments since the last check are searched, not the whole output so far
+                window = tail + "".join(recent)
+                recent.clear()
+                tail = window[-_MARKER_TAIL:]
+                structured = any(marker in window for marker in _EARLY_MARKERS)
+                if not structured and tokens >= STREAM_ABORT_AFTER:
+                    # Leaving the block closes the connection, which stops the generation server-side
+                    log.info(f"🛑 {model} produced no section headers in {tokens} tokens. Aborting.")
+                    return None
+            if data.get("done"):
+                break
+    return "".join(parts).strip()
+
+# Bits 0-4 are the required sections (alternative spellings share a bit); the rest feed the flowchart check.
+# "## Process Steps" also sets the "Process" bit because finditer consumes the whole header.
+_FLOWCHART, _FENCE, _PROCESS = 1 << 5, 1 << 6, 1 << 7
+_STRUCT_BITS = {
+    "## Identification": 1 << 0,
+    "## Description": 1 << 1,
+    "## Process Steps": 1 << 2 | _PROCESS,
+    "## Input Type Validation Checks": 1 << 3,
+    "## Input Validation": 1 << 3,
+    "## Validation Rules": 1 << 3,
+    "## Entities Used / Tables Used": 1 << 4,
+    "## Entities Used": 1 << 4,
+    "## Tables Used": 1 << 4,
+    "## Flowchart": _FLOWCHART,
+    "```": _FENCE,
+    "Process": _PROCESS,
+}
+_STRUCT_RE = re.compile("|".join(re.escape(marker) for marker in _STRUCT_BITS))
+
+def structure_mask(text):
+    mask = 0
+    for m in _STRUCT_RE.finditer(text):
+        mask |= _STRUCT_BITS[m.group(0)]
+    return mask
+
+def has_flowchart(mask):
+    return bool(mask & _FLOWCHART) or (mask & (_FENCE | _PROCESS)) == _FENCE | _PROCESS
 
 def is_structured_output(text):
-    sections = [
-        "## Identification",
-        "## Description",
-        "## Process Steps",
-        ("## Input Type Validation Checks", "## Input Validation", "## Validation Rules"),
-        ("## Entities Used / Tables Used", "## Entities Used", "## Tables Used")
-    ]
-    found = 0
-    for s in sections:
-        if isinstance(s, tuple):
-            if any(sub in text for sub in s):
-                found += 1
-        elif s in text:
-            found += 1
-    return found >= 3 or (ALLOW_FLOWCHART and has_flowchart(text))
+    mask = structure_mask(text)
+    return bin(mask & 0b11111).count("1") >= 3 or (ALLOW_FLOWCHART and has_flowchart(mask))
+
+# "Entities Used" skips the already-correct "Entities Used / Tables Used" so it isn't expanded twice
+_HDR_RE = re.compile(r"## (?:Input Validation|Validation Rules|Entities Used(?! / Tables Used)|Tables Used)")
+_HDR_MAP = {
+    "## Input Validation": "## Input Type Validation Checks",
+    "## Validation Rules": "## Input Type Validation Checks",
+    "## Entities Used": "## Entities Used / Tables Used",
+    "## Tables Used": "## Entities Used / Tables Used"
+}
 
 def normalize_headers(text):
-    replacements = {
-        "## Input Validation": "## Input Type Validation Checks",
-        "## Validation Rules": "## Input Type Validation Checks",
-        "## Entities Used": "## Entities Used / Tables Used",
-        "## Tables Used": "## Entities Used / Tables Used"
-    }
-    for wrong, correct in replacements.items():
-        text = text.replace(wrong, correct)
-    return text
+    return _HDR_RE.sub(lambda m: _HDR_MAP[m.group(0)], text)
+
+_HEADER_RE = re.compile(r"^#{2,}\s+(.*)")
+# Checked in order, so an earlier keyword wins when a title contains several
+_SECTION_KEYWORDS = (
+    ("identification", "Identification"),
+    ("description", "Description"),
+    ("pre-condition", "Pre-Condition"),
+    ("post-condition", "Post-Condition"),
+    ("entities used", "Entities Used / Tables Used"),
+    ("tables used", "Entities Used / Tables Used"),
+    ("steps", "Program Steps"),
+    ("test", "Tests Needed"),
+)
 
 def to_narrative_format(use_case_text):
     sections = {
@@ -173,26 +348,10 @@ def to_narrative_format(use_case_text):
     current = None
     lines = use_case_text.splitlines()
     for line in lines:
-        match = re.match(r"^##+\s+(.*)", line)
+        match = _HEADER_RE.match(line)
         if match:
-            title = match.group(1).strip()
-            norm = title.lower()
-            if "identification" in norm:
-                current = "Identification"
-            elif "description" in norm:
-                current = "Description"
-            elif "pre-condition" in norm:
-                current = "Pre-Condition"
-            elif "post-condition" in norm:
-                current = "Post-Condition"
-            elif "entities used" in norm or "tables used" in norm:
-                current = "Entities Used / Tables Used"
-            elif "steps" in norm:
-                current = "Program Steps"
-            elif "test" in norm:
-                current = "Tests Needed"
-            else:
-                current = None
+            norm = match.group(1).strip().lower()
+            current = next((section for keyword, section in _SECTION_KEYWORDS if keyword in norm), None)
         elif current:
             sections[current] += line.strip() + "\n"
 
@@ -212,73 +371,321 @@ def to_narrative_format(use_case_text):
     return "\n".join(result).strip()
 
 
-def process_chunk(chunk_index, chunk, template_lines, output_dir, log_dir):
-    if is_similar_to_template(chunk, template_lines):
-        print(f"⏭️ Skipping chunk {chunk_index+1} (matches template)")
+CACHE = {}  # sha256 of cache scope + normalized chunk -> model output
+# Unit-length embeddings of cached chunks, one row per entry in _cache_results; grown by doubling
+_cache_embs = np.empty((0, 0), dtype=np.float32)
+_cache_results = []
+_faiss_index = None
+
+# What a cached answer depends on besides the chunk itself
+_CACHE_SCOPE = hashlib.sha256("\0".join(
+    (PRIMARY_MODEL, FALLBACK_MODEL, EMBED_MODEL, _PROMPT_PREFIX, _PROMPT_SUFFIX)).encode("utf-8")).hexdigest()
+
+def cache_key(chunk):
+    return hashlib.sha256((_CACHE_SCOPE + " ".join(chunk.lower().split())).encode("utf-8")).hexdigest()
+
+def load_cache():
+    try:
+        with open(SEMANTIC_CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        log.info(f"⚠️ Ignoring unreadable cache {SEMANTIC_CACHE_FILE}: {e}")
+        return
+    if data.get("scope") != _CACHE_SCOPE:
+        # Written for another prompt or model; the embeddings would otherwise keep matching
+        log.info(f"♻️ Prompt or models changed since {SEMANTIC_CACHE_FILE} was written; starting a fresh cache")
+        return
+    CACHE.update(data.get("exact", {}))
+    for vec, result in data.get("semantic", []):
+        semantic_add(np.asarray(vec, dtype=np.float32), result)
+    log.info(f"♻️ Loaded {len(CACHE)} cached results from {SEMANTIC_CACHE_FILE}")
+
+def save_cache():
+    with open(SEMANTIC_CACHE_FILE, "w", encoding="utf-8") as f:
+        semantic = [[row.tolist(), result] for row, result in zip(_cache_embs, _cache_results)]
+        json.dump({"scope": _CACHE_SCOPE, "exact": CACHE, "semantic": semantic}, f)
+
+async def embed_chunks(client, texts):
+    # One request per batch instead of one per chunk; rows come back L2-normalized so dot product = cosine
+    vecs = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        try:
+            resp = await client.post("/api/embed", json={
+                "model": EMBED_MODEL, "input": texts[start:start+EMBED_BATCH_SIZE], "keep_alive": OLLAMA_KEEP_ALIVE
+            })
+            resp.raise_for_status()
+            vecs.extend(resp.json()["embeddings"])
+        except (httpx.HTTPError, KeyError) as e:
+            log.info(f"⚠️ Embedding failed, skipping semantic cache: {e}")
+            return None
+    if not vecs:
+        return None
+    embs = np.asarray(vecs, dtype=np.float32)
+    embs /= np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+    return embs
+
+def semantic_add(vec, result):
+    global _cache_embs, _faiss_index
+    n = len(_cache_results)
+    if n == _cache_embs.shape[0]:
+        grown = np.empty((max(2 * n, 64), vec.shape[0]), dtype=np.float32)
+        if n:
+            grown[:n] = _cache_embs
+        _cache_embs = grown
+    _cache_embs[n] = vec
+    _cache_results.append(result)
+    if _faiss_index is not None:
+        _faiss_index.add(vec[None, :])
+    elif faiss is not None and n + 1 > FAISS_MIN_ENTRIES:
+        _faiss_index = faiss.IndexFlatIP(vec.shape[0])
+        _faiss_index.add(_cache_embs[:n + 1])
+
+def semantic_lookup(vec):
+    n = len(_cache_results)
+    if not n:
+        return None
+    if _faiss_index is not None:
+        sims, ids = _faiss_index.search(vec[None, :], 1)
+        best, sim = int(ids[0][0]), float(sims[0][0])
+    else:
+        sims = _cache_embs[:n] @ vec
+        best = int(sims.argmax())
+        sim = float(sims[best])
+    return _cache_results[best] if sim > SEMANTIC_CACHE_THRESHOLD else None
+
+async def warmup_model(client, model):
+    # An empty prompt just loads the model, so the first real chunk doesn't pay the load time
+    try:
+        resp = await client.post("/api/generate", json={
+            "model": model, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE, "options": {"num_ctx": OLLAMA_NUM_CTX}
+        })
+        resp.raise_for_status()
+    except httpx.HTTPError as e:
+        log.info(f"⚠️ Could not preload {model}: {e}")
+
+def find_leads(keys, misses, embs):
+    """
+    For each chunk not answerable from the cache at the start of the run, the position of an earlier
+    chunk with the same key or an embedding above SEMANTIC_CACHE_THRESHOLD, so it can wait for that
+    chunk's answer instead of generating alongside it
+    """
+    leads = [None] * len(keys)
+    first = {}  # cache key -> position of the first chunk with it
+    lead_rows = []  # rows of embs belonging to chunks that generate their own answer
+    for row, pos in enumerate(misses):
+        if keys[pos] in first:
+            leads[pos] = first[keys[pos]]
+            continue
+        if embs is not None and lead_rows:
+            sims = embs[lead_rows] @ embs[row]
+            best = int(sims.argmax())
+            if sims[best] > SEMANTIC_CACHE_THRESHOLD:
+                leads[pos] = misses[lead_rows[best]]
+                continue
+        first[keys[pos]] = pos
+        lead_rows.append(row)
+    return leads
+
+async def process_chunk(client, sem, chunk_index, chunk, key, vec, template_set, output_dir, log_dir, lead, done):
+    # lead: future for an earlier near-duplicate chunk's answer; done: where this chunk's answer is posted
+    try:
+        return await _process_chunk(client, sem, chunk_index, chunk, key, vec, template_set,
+                                    output_dir, log_dir, lead, done)
+    finally:
+        if not done.done():
+            done.set_result(None)  # Never leave a duplicate waiting
+
+async def _process_chunk(client, sem, chunk_index, chunk, key, vec, template_set, output_dir, log_dir, lead, done):
+    if is_similar_to_template(chunk, template_set):
+        log.info(f"⏭️ Skipping chunk {chunk_index+1} (matches template)")
         return None
 
-    prompt = build_prompt(chunk)
-    start_time = time.time()
+    # Collected and logged as one record so concurrent chunks don't interleave line by line
+    notes = []
+    start_time = time.perf_counter()
+    result = None
+    if lead is not None:
+        # Overlapping windows answered by the earlier chunk; if that failed, this one tries itself
+        result = await lead
+        if result:
+            notes.append(f"♻️ Chunk {chunk_index+1}: reused the answer of an earlier near-identical chunk")
+            CACHE[key] = result
+    if SEMANTIC_CACHE and not result:
+        result = CACHE.get(key)
+        if result:
+            notes.append(f"♻️ Chunk {chunk_index+1}: exact cache hit")
+        elif vec is not None:
+            result = semantic_lookup(vec)
+            if result:
+                notes.append(f"♻️ Chunk {chunk_index+1}: semantic cache hit")
+                CACHE[key] = result
 
-    result = run_ollama(PRIMARY_MODEL, prompt)
     if not result:
-        print("🔁 Primary model failed. Trying fallback...")
-        result = run_ollama(FALLBACK_MODEL, prompt)
+        prompt = build_prompt(chunk)
+        async with sem:
+            start_time = time.perf_counter()
+
+            result = await run_ollama(client, PRIMARY_MODEL, prompt)
+            if not result:
+                notes.append("🔁 Primary model failed. Trying fallback...")
+                result = await run_ollama(client, FALLBACK_MODEL, prompt)
 
-    duration = int(time.time() - start_time)
-    print(f"⏳ Chunk {chunk_index+1} took {duration}s")
+        if result and SEMANTIC_CACHE:
+            CACHE[key] = result
+            if vec is not None:
+                semantic_add(vec, result)
+    done.set_result(result)
 
+    duration = time.perf_counter() - start_time
+    notes.append(f"⏳ Chunk {chunk_index+1} took {duration:.1f}s")
+
+    saved = None
     if result:
         result = normalize_headers(result)
 
         if DEBUG:
-            print(f"\n🧾 Output preview for chunk {chunk_index+1}:\n" + "-"*50)
-            print("\n".join(result.splitlines()[:10]) + "\n...")
+            notes.append(f"\n🧾 Output preview for chunk {chunk_index+1}:\n" + "-"*50)
+            notes.append("\n".join(result.split("\n", 10)[:10]) + "\n...")
 
         if is_structured_output(result):
             filename = f"use_case_{chunk_index+1:02d}.md"
             filepath = os.path.join(output_dir, filename)
             with open(filepath, 'w') as f:
                 f.write(result + "\n")
-            print(f"✅ Chunk {chunk_index+1}: Saved structured use case.")
-            return result
+            notes.append(f"✅ Chunk {chunk_index+1}: Saved structured use case.")
+            saved = result
         else:
             fail_path = os.path.join(log_dir, f"failed_chunk_{chunk_index+1:02d}.txt")
             with open(fail_path, "w") as f:
                 f.write(result)
-            print(f"❌ Chunk {chunk_index+1}: Format check failed. Logged to {fail_path}")
-            return None
+            notes.append(f"❌ Chunk {chunk_index+1}: Format check failed. Logged to {fail_path}")
     else:
-        print(f"❌ Chunk {chunk_index+1}: Model completely failed.")
-        return None
-
-def fuzzy_deduplicate(use_cases):
+        notes.append(f"❌ Chunk {chunk_index+1}: Model completely failed.")
+
+    log.info("\n".join(notes))
+    return saved
+
+async def process_all_chunks(chunks, template_set, output_dir, log_dir):
+    # chunks is a list of (chunk_index, chunk) so output files keep their position in the source
+    sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    # One client for the whole run so every chunk reuses the same keep-alive connections
+    async with httpx.AsyncClient(base_url=OLLAMA_URL, timeout=TIMEOUT) as client:
+        await warmup_model(client, PRIMARY_MODEL)
+        keys = [None] * len(chunks)
+        vecs = [None] * len(chunks)
+        leads = [None] * len(chunks)
+        if SEMANTIC_CACHE:
+            keys = [cache_key(chunk) for _, chunk in chunks]
+            # Only chunks that can't be answered from the exact cache need an embedding
+            misses = [pos for pos, (_, chunk) in enumerate(chunks)
+                      if keys[pos] not in CACHE and not is_similar_to_template(chunk, template_set)]
+            embs = await embed_chunks(client, [chunks[pos][1] for pos in misses])
+            if embs is not None:
+                for row, pos in enumerate(misses):
+                    vecs[pos] = embs[row]
+            # Every task starts up front, so duplicates within this run wait on their lead chunk;
+            # a cache lookup alone would run before the lead had stored anything
+            leads = find_leads(keys, misses, embs)
+        loop = asyncio.get_running_loop()
+        answers = [loop.create_future() for _ in chunks]
+        tasks = [
+            asyncio.ensure_future(process_chunk(
+                client, sem, i, chunk, keys[pos], vecs[pos], template_set, output_dir, log_dir,
+                answers[leads[pos]] if leads[pos] is not None else None, answers[pos]))
+            for pos, (i, chunk) in enumerate(chunks)
+        ]
+        # All chunks run concurrently, but results are handed out in chunk order as soon as
+        # every earlier chunk has finished
+        for task in tasks:
+            yield await task
+
+def minhash_signature(text):
+    tokens = text.split()
+    mh = MinHash(num_perm=MINHASH_NUM_PERM)
+    for i in range(max(len(tokens) - 1, 1)):
+        mh.update(" ".join(tokens[i:i+2]).encode("utf-8"))
+    return mh
+
+def is_near_duplicate(uc, candidates):
+    if fuzz_process is not None:
+        # One C call for the whole candidate list instead of a Python loop over SequenceMatcher.
+        # processor=None: rapidfuzz < 3 lowercases and strips by default. The cutoff accepts an equal
+        # score, so the best match is checked against the threshold strictly, as ratio() is below
+        best = fuzz_process.extractOne(uc, candidates, scorer=fuzz.ratio, processor=None,
+                                       score_cutoff=FUZZY_SIMILARITY_THRESHOLD * 100)
+        return best is not None and best[1] > FUZZY_SIMILARITY_THRESHOLD * 100
+    return any(SequenceMatcher(None, uc, existing).ratio() > FUZZY_SIMILARITY_THRESHOLD for existing in candidates)
+
+def fuzzy_deduplicator():
+    # Online version of the dedupe: returns a function that says whether each new use case
+    # is unique against everything accepted so far
     seen = []
-    deduped = []
-    for uc in use_cases:
-        if not any(SequenceMatcher(None, uc, existing).ratio() > FUZZY_SIMILARITY_THRESHOLD for existing in seen):
-            seen.append(uc)
-            deduped.append(uc)
-    return deduped
+    lsh = MinHashLSH(threshold=MINHASH_LSH_THRESHOLD, num_perm=MINHASH_NUM_PERM) if MinHashLSH else None
+
+    def is_new(uc):
+        if lsh is not None:
+            mh = minhash_signature(uc)
+            candidates = [seen[key] for key in lsh.query(mh)]
+        else:
+            candidates = seen
+        if is_near_duplicate(uc, candidates):
+            return False
+        if lsh is not None:
+            lsh.insert(len(seen), mh)
+        seen.append(uc)
+        return True
+
+    return is_new
+
+async def write_summary(chunks, template_set, output_dir, log_dir, summary_file):
+    is_new = fuzzy_deduplicator()
+    unique = 0
+    with open(summary_file, "w", buffering=1 << 16) as f:
+        async for result in process_all_chunks(chunks, template_set, output_dir, log_dir):
+            if result and is_new(result):
+                f.write(to_narrative_format(result))
+                f.write("\n\n" + "="*60 + "\n\n")
+                f.flush()
+                unique += 1
+    return unique
 
 # === MAIN ===
 if __name__ == "__main__":
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    _llm_cache = shelve.open(LLM_CACHE_FILE)
+    atexit.register(_llm_cache.close)
+
+    all_lines = []
     for file in SOURCE_FILES:
-        if not os.path.exists(file):
-            print(f"❌ Source file not found: {file}")
+        try:
+            all_lines.extend(read_lines(file))
+        except FileNotFoundError:
+            log.info(f"❌ Source file not found: {file}")
             exit(1)
 
-    if not os.path.exists(USE_CASE_TEMPLATE_FILE):
-        print(f"❌ Template file not found: {USE_CASE_TEMPLATE_FILE}")
+    try:
+        template_lines = read_lines(USE_CASE_TEMPLATE_FILE)
+    except FileNotFoundError:
+        log.info(f"❌ Template file not found: {USE_CASE_TEMPLATE_FILE}")
         exit(1)
+    template_set = frozenset(line.strip() for line in template_lines if line.strip())
+    if SEMANTIC_CACHE:
+        load_cache()
 
-    template_lines = read_lines(USE_CASE_TEMPLATE_FILE)
-
-    all_lines = []
-    for file in SOURCE_FILES:
-        all_lines.extend(read_lines(file))
+    chunker = logical_chunks if USE_LOGICAL_CHUNKS else sliding_chunks
+    merged_chunks = list(chunker(all_lines))
 
-    merged_chunks = sliding_chunks(all_lines)
+    # Identical windows (e.g. repeated code across files) only need to go to the model once
+    seen_hashes = set()
+    unique_chunks = []
+    for i, chunk in enumerate(merged_chunks):
+        h = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+        if h not in seen_hashes:
+            seen_hashes.add(h)
+            unique_chunks.append((i, chunk))
 
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_dir = os.path.join(OUTPUT_BASE, f"mistral_narrative_run_{timestamp}")
@@ -286,20 +693,13 @@ if __name__ == "__main__":
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(log_dir, exist_ok=True)
 
-    print(f"🚀 Starting Mistral-first narrative analysis of {len(merged_chunks)} chunks...\n")
-
-    all_results = []
-    for i, chunk in enumerate(merged_chunks):
-        result = process_chunk(i, chunk, template_lines, output_dir, log_dir)
-        if result:
-            all_results.append(result)
+    log.info(f"🚀 Starting Mistral-first narrative analysis of {len(unique_chunks)} chunks "
+          f"({len(merged_chunks) - len(unique_chunks)} exact duplicates skipped)...\n")
 
-    final = fuzzy_deduplicate(all_results)
     summary_file = os.path.join(output_dir, "SUMMARY.md")
-    with open(summary_file, "w") as f:
-        for i, uc in enumerate(final, 1):
-            f.write(to_narrative_format(uc))
-            f.write("\n\n" + "="*60 + "\n\n")
+    unique = asyncio.run(write_summary(unique_chunks, template_set, output_dir, log_dir, summary_file))
+    if SEMANTIC_CACHE:
+        save_cache()
 
-    print(f"\n✅ {len(final)} unique use cases saved to {output_dir}")
-    print(f"🪵 Logs saved to {log_dir}")
+    log.info(f"\n✅ {unique} unique use cases saved to {output_dir}")
+    log.info(f"🪵 Logs saved to {log_dir}")
@@ -1,23 +1,83 @@
+import asyncio
+import codecs
+import hashlib
+import io
+import itertools
+import json
+import math
 import os
 import re
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from copy import deepcopy
 from datetime import datetime
 from difflib import SequenceMatcher
-import subprocess
+from pathlib import Path
+import httpx
 from docx import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+try:
+    from datasketch import MinHash, MinHashLSH
+except ImportError:  # pip install datasketch; otherwise a token-set Jaccard prefilter is used
+    MinHash = MinHashLSH = None
+
+try:
+    import diskcache
+except ImportError:  # pip install diskcache; without it Ollama responses aren't reused between runs
+    diskcache = None
 
 # === CONFIGURATION ===
 PRIMARY_MODEL = "mistral:7b-instruct"
 FALLBACK_MODEL = "codellama:13b-instruct-q4_K_M"
+FAST_MODEL = "mistral:7b-instruct-q3_K_S"  # Smaller quantization of the primary (whose default tag is Q4_0), for long chunks
 TIMEOUT = 60  # Reduced timeout for faster processing
 CHUNK_SIZE = 90  # Original size
-CHUNK_OVERLAP = 30  # Original overlap
+CHUNK_OVERLAP = 22  # About a quarter of the chunk, so each line is sent ~1.3 times instead of 1.5
+# Chunks over this many estimated tokens (~3.5 chars each) go straight to FAST_MODEL instead of timing out
+# on the primary first. A full chunk of 100-column fixed-form source stays under it (90 80-column lines are
+# ~7.3k chars, ~2.1k tokens), so only chunks with long free-form lines are rerouted
+LONG_CHUNK_TOKENS = int(CHUNK_SIZE * 100 / 3.5)
 FUZZY_THRESHOLD = 0.94
-TEMPLATE_FILE = "use_case_template.md"
+MINHASH_NUM_PERM = 64
+# Estimated char 5-gram Jaccard for a pair to get the SequenceMatcher check. This is not the same scale as
+# FUZZY_THRESHOLD: pairs above a 0.94 ratio go as low as ~0.79, and 0.5 still proposes those 99.9% of the time
+LSH_THRESHOLD = 0.5
+JACCARD_PREFILTER = 0.7  # Without datasketch, only pairs sharing this much of their word set get the full comparison
 OUTPUT_BASE = "use_case_outputs"
 INCLUDE_AP200 = False  # Simplified - no extra context
 MIN_ACCEPTANCE_SCORE = 0.5  # Threshold for accepting use cases even if not perfect
+# Hash of the system prompt (without its date) and chunk -> Ollama response and the date it was stamped with
+RESPONSE_CACHE_DIR = ".rpg_cache"
+OLLAMA_URL = "http://localhost:11434"
+# Keep the primary resident across the whole batch; same variable name as the server-side default
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+# Only the primary is warmed up and pinned. The 13B fallback (~12.5 GiB of KV cache on top of its weights, see
+# OLLAMA_NUM_CTX) is unloaded after each request, and FAST_MODEL soon after the last long chunk
+WARMUP_MODELS = [PRIMARY_MODEL]
+MODEL_KEEP_ALIVE = {PRIMARY_MODEL: OLLAMA_KEEP_ALIVE, FAST_MODEL: "5m", FALLBACK_MODEL: 0}
+# Requests in flight at once across all file workers; start the Ollama server with OLLAMA_NUM_PARALLEL=4 (or higher)
+# so they run in parallel. --all divides these slots between the files rather than giving each file all of them
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# Files processed at once with --all; each worker post-processes one file while Ollama works on the others
+FILE_WORKERS = min(4, os.cpu_count() or 1, OLLAMA_NUM_PARALLEL)
+DOCX_WRITERS = 4  # Threads saving per-use-case .docx files while the next results are post-processed
+BATCH_SIZE = 4  # Chunks packed into one generate request; set to 1 for one request per chunk
+UC_SEPARATOR = "---UC-SEP---"
+NUM_PREDICT = 800  # Token cap per use case (multiplied by the number of chunks in a batched request)
+STOP_SEQUENCES = ["[END CODE]", "\n\n---\n"]
+# Context per model, kept fixed so a model isn't reloaded between requests. Only the primary gets batched
+# requests: system prompt (~400 tokens) plus BATCH_SIZE chunks short enough to batch and their answers.
+# Ollama allocates the KV cache for every parallel slot, so each loaded model holds
+# num_ctx * OLLAMA_NUM_PARALLEL tokens of it: about 7 GiB for the primary (GQA, ~128 KiB/token at f16)
+# and about 12.5 GiB for the 13B fallback (~800 KiB/token) at the defaults
+OLLAMA_NUM_CTX = {
+    PRIMARY_MODEL: 1024 * math.ceil((512 + BATCH_SIZE * (LONG_CHUNK_TOKENS + NUM_PREDICT)) / 1024),
+    FAST_MODEL: 8192,  # One chunk past LONG_CHUNK_TOKENS and its answer
+    FALLBACK_MODEL: 4096,  # One ordinary chunk and its answer
+}
 
 # === ALL FILES TO PROCESS ===
 ALL_RPG_FILES = [
@@ -30,24 +90,37 @@ ALL_RPG_FILES = [
 SOURCE_DIR = r"C:\Temp\IBM-GitHub-Submission-Unedited\IBM-GitHub-Submission\QSRC"
 
 def read_lines(path):
+    data = Path(path).read_bytes()
+    if not data:
+        return []
+    if data.startswith(codecs.BOM_UTF8):
+        return data.decode("utf-8-sig").splitlines()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return [line.rstrip("\n") for line in f.readlines()]
+        return data.decode("utf-8").splitlines()
     except UnicodeDecodeError:
         # Fallback to another encoding if utf-8 fails
-        with open(path, "r", encoding="latin-1") as f:
-            return [line.rstrip("\n") for line in f.readlines()]
+        return data.decode("latin-1").splitlines()
 
 def chunk_lines(lines, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    # Join the file once and slice each window out of it by line offsets
     step = size - overlap
-    return ['\n'.join(lines[i:i + size]) for i in range(0, len(lines), step)]
+    text = '\n'.join(lines)
+    offsets = [0] + list(itertools.accumulate(len(line) + 1 for line in lines))
+    for i in range(0, len(lines), step):
+        end = min(i + size, len(lines))
+        yield text[offsets[i]:offsets[end] - 1]
 
-def build_prompt(template, chunk, context=None, program="XXX"):
+def build_system_prompt(program="XXX", now_str=None, context=None):
+    """
+    Instructions and output template, sent once per request as the system message.
+    It's identical for every chunk of a file, so Ollama can reuse its cached prefill.
+    """
+    now_str = now_str or datetime.now().strftime('%m.%d.%Y')
     context_block = f"\nReference context from AP200 (not primary logic):\n{context}\n" if context else ""
     
     # Updated prompt to match the desired output format
     return f"""You are analyzing IBM RPG code to extract business logic use cases.
-Review this code from program AP{program} and extract meaningful business use cases.
+Review the code from program AP{program} given between [RPG CODE] and [END CODE] and extract meaningful business use cases.
 
 Your output MUST follow this EXACT template:
 
@@ -63,11 +136,11 @@ Your output MUST follow this EXACT template:
 
 **Version**: 1.0
 
-**Last Update:** {datetime.now().strftime('%m.%d.%Y')}
+**Last Update:** {now_str}
 
 **Last Update By:** System Generated
 
-**Created:** {datetime.now().strftime('%m.%d.%Y')}
+**Created:** {now_str}
 
 **Created By:** System Generated
 
@@ -95,114 +168,319 @@ Your output MUST follow this EXACT template:
 [List important business rules and validations]
 
 {context_block}
-[RPG CODE]
-{chunk}
-[END CODE]
-
 Be concise but thorough. Focus on meaningful business logic related to vouchers, GL, invoices, payment processing, etc.
 """
 
-def run_ollama(model, prompt):
+def build_prompt(chunk):
+    """The per-chunk user message: just the code"""
+    return f"[RPG CODE]\n{chunk}\n[END CODE]"
+
+def template_end(text, expected=1):
+    """
+    Offset where output past the template starts: after the last expected "**Business Rules:**"
+    section, the first paragraph that is neither a list nor a header. -1 while still incomplete.
+    """
+    pos = -1
+    for _ in range(expected):
+        pos = text.find(RULES_HEADER, pos + 1)
+        if pos < 0:
+            return -1
+    match = _RULES_DONE_RE.search(text, pos + len(RULES_HEADER))
+    return match.end() if match else -1
+
+async def run_ollama(client, model, system, prompt, stats, expected=1):
     try:
-        result = subprocess.run(
-            ["ollama", "run", model],
-            input=prompt.encode(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=TIMEOUT
-        )
-        return result.stdout.decode().strip()
-    except subprocess.TimeoutExpired:
+        # The client timeout only limits the wait between streamed lines; this bounds the whole
+        # generation, scaled for a batched request writing several use cases
+        return await asyncio.wait_for(stream_chat(client, model, system, prompt, stats, expected), TIMEOUT * expected)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
         print(f"Timeout using {model}")
         return None
     except Exception as e:
         print(f"Error running ollama: {e}")
         return None
 
-def normalize_headers(text, program):
+async def stream_chat(client, model, system, prompt, stats, expected):
+    parts = []
+    async with client.stream("POST", "/api/chat", json={
+        "model": model, "stream": True, "keep_alive": MODEL_KEEP_ALIVE[model],
+        "messages": [{"role": "system", "content": system}, {"role": "user", "content": prompt}],
+        "options": {"num_ctx": OLLAMA_NUM_CTX[model], "num_predict": NUM_PREDICT * expected, "stop": STOP_SEQUENCES}
+    }) as resp:
+        resp.raise_for_status()
+        stats["requests"] += 1
+        async for line in resp.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            parts.append(data.get("message", {}).get("content", ""))
+            if data.get("done"):
+                for key in ("prompt_eval_count", "eval_count", "total_duration"):
+                    stats[key] += data.get(key, 0)
+                break
+            # Everything the template asks for has been written; leaving the block
+            # closes the connection and Ollama stops generating
+            if len(parts) % 16 == 0:
+                text = "".join(parts)
+                end = template_end(text, expected)
+                if end >= 0:
+                    stats["eval_count"] += len(parts)
+                    parts = [text[:end]]
+                    break
+    return "".join(parts).strip()
+
+_CLIENT = None
+_LOOP = None
+
+def _client():
+    """One connection pool per process, shared by every file that process handles"""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(base_url=OLLAMA_URL, timeout=httpx.Timeout(TIMEOUT),
+                                    limits=httpx.Limits(max_keepalive_connections=16))
+    return _CLIENT
+
+def run_async(coro):
+    # The client's connections belong to the loop that opened them, so every
+    # file in this process runs on the same loop instead of a fresh asyncio.run()
+    global _LOOP
+    if _LOOP is None:
+        _LOOP = asyncio.new_event_loop()
+    return _LOOP.run_until_complete(coro)
+
+def close_client():
+    global _CLIENT, _LOOP
+    if _CLIENT is not None:
+        run_async(_CLIENT.aclose())
+        _CLIENT = None
+    if _LOOP is not None:
+        _LOOP.close()
+        _LOOP = None
+
+async def warmup_models():
+    """Load each model once up front so no chunk pays for the cold load"""
+    for model in WARMUP_MODELS:
+        start = time.perf_counter()
+        try:
+            # An empty prompt only loads the model and applies keep_alive
+            resp = await _client().post("/api/generate", json={
+                "model": model, "prompt": "", "keep_alive": MODEL_KEEP_ALIVE[model],
+                "options": {"num_ctx": OLLAMA_NUM_CTX[model]}
+            }, timeout=300)
+            resp.raise_for_status()
+            print(f"🔥 {model} loaded in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            print(f"⚠️ Could not preload {model}: {e}")
+
+def build_batch_prompt(prompts):
+    parts = [
+        f"You will receive {len(prompts)} separate tasks, each between ### CHUNK n and ### END n.\n"
+        f"Emit exactly one use case per CHUNK, in order, separated by a line containing only {UC_SEPARATOR}\n"
+    ]
+    for n, prompt in enumerate(prompts, 1):
+        parts.append(f"### CHUNK {n}\n{prompt}\n### END {n}")
+    return "\n".join(parts)
+
+def pick_model(prompt):
+    return PRIMARY_MODEL if len(prompt) / 3.5 < LONG_CHUNK_TOKENS else FAST_MODEL
+
+async def generate_one(client, sem, i, system, prompt, total, stats):
+    async with sem:
+        print(f"Processing chunk {i+1}/{total}")
+
+        # Try primary model first, or the faster quantization if the chunk is long enough to likely time out
+        model = pick_model(prompt)
+        print(f"Trying with {model}")
+        result = await run_ollama(client, model, system, prompt, stats)
+
+        # Fall back to secondary model if needed
+        if not result:
+            print(f"Falling back to {FALLBACK_MODEL}")
+            result = await run_ollama(client, FALLBACK_MODEL, system, prompt, stats)
+        return result
+
+async def generate_batch(client, sem, indices, system, batch, total, stats):
+    # Long chunks aren't packed with others; each goes on its own to FAST_MODEL
+    if len(batch) > 1 and all(pick_model(prompt) == PRIMARY_MODEL for prompt in batch):
+        names = ", ".join(str(i + 1) for i in indices)
+        async with sem:
+            print(f"Processing chunks {names}/{total} in one request")
+            raw = await run_ollama(client, PRIMARY_MODEL, system, build_batch_prompt(batch), stats, len(batch))
+        if raw:
+            outputs = [part.strip() for part in raw.split(UC_SEPARATOR) if part.strip()]
+            if len(outputs) == len(batch):
+                return outputs
+        print(f"Batch for chunks {names} did not split into {len(batch)} use cases, "
+              f"retrying one chunk per request")
+    return await asyncio.gather(*[
+        generate_one(client, sem, i, system, prompt, total, stats) for i, prompt in zip(indices, batch)
+    ])
+
+async def generate_all(system, prompts, concurrency=OLLAMA_NUM_PARALLEL):
+    """Run every prompt against Ollama, concurrency at a time; results come back in prompt order"""
+    sem = asyncio.Semaphore(concurrency)
+    stats = {"requests": 0, "prompt_eval_count": 0, "eval_count": 0, "total_duration": 0}
+    client = _client()
+    # Batch chunks of similar length together, longest first so the slowest requests
+    # start early instead of trailing at the end
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]), reverse=True)
+    groups = [order[start:start + BATCH_SIZE] for start in range(0, len(order), BATCH_SIZE)]
+    batches = await asyncio.gather(*[
+        generate_batch(client, sem, group, system, [prompts[i] for i in group], len(prompts), stats)
+        for group in groups
+    ])
+    per_request = stats['prompt_eval_count'] // max(stats['requests'], 1)
+    print(f"Ollama: {stats['requests']} requests, {stats['prompt_eval_count']} prompt tokens ({per_request}/request), "
+          f"{stats['eval_count']} generated tokens, {stats['total_duration'] / 1e9:.1f}s model time")
+    results = [None] * len(prompts)
+    for group, batch in zip(groups, batches):
+        for i, result in zip(group, batch):
+            results[i] = result
+    return results
+
+async def generate_cached(system, prompts, now_str, concurrency=OLLAMA_NUM_PARALLEL):
+    """
+    generate_all, but prompts answered in an earlier run are read from the disk cache.
+    now_str is left out of the key, and cached answers from another day get it stamped in instead.
+    """
+    if diskcache is None:
+        return await generate_all(system, prompts, concurrency)
+    with diskcache.Cache(RESPONSE_CACHE_DIR) as cache:
+        undated = system.replace(now_str, "")
+        keys = [hashlib.blake2b(f"{undated}\0{prompt}".encode("utf-8")).hexdigest() for prompt in prompts]
+        results = [None] * len(prompts)
+        for i, key in enumerate(keys):
+            entry = cache.get(key)
+            if entry is not None:
+                date, result = entry
+                results[i] = result.replace(date, now_str) if date != now_str else result
+        misses = [i for i, result in enumerate(results) if result is None]
+        if len(misses) < len(prompts):
+            print(f"{len(prompts) - len(misses)} chunks answered from {RESPONSE_CACHE_DIR}")
+        fresh = await generate_all(system, [prompts[i] for i in misses], concurrency) if misses else []
+        for i, result in zip(misses, fresh):
+            results[i] = result
+            if result:
+                cache[keys[i]] = (now_str, result)
+    return results
+
+# === PRECOMPILED PATTERNS ===
+SECTIONS = [
+    "Identification", "Description", "Pre-Condition", "Post-Condition",
+    "Entities Used / Tables Used", "Process Steps", "Tests Needed", "Business Rules"
+]
+_MD_H1 = re.compile(r"# (.+)")
+# Any "##"/"###" variant of a section header, rewritten in a single pass
+_HEADER_ALT = re.compile(r"##+\s+(" + "|".join(re.escape(s) for s in SECTIONS) + r")s?")
+_ID_RE = re.compile(r"Use Case ID\*\*: UC-AP-(\d+)-(\d{3})")
+_ID_LINE_RE = re.compile(r"(\*\*Use Case ID:\*\* [^\n]+)")
+_MODULE_GROUP_RE = re.compile(r"(\*\*Module Group:[^\n]+)")
+_TITLE_RE = re.compile(r"^\*\*([^*]+)\*\*")
+_FILENAME_CLEAN = re.compile(r'[^a-zA-Z0-9\- ]+')
+_DASH_COLLAPSE = re.compile(r'-+')
+_PROGRAM_RE = re.compile(r"AP(\d+)")
+RULES_HEADER = "**Business Rules:**"
+SUMMARY_SEPARATOR = "\n\n" + "=" * 60 + "\n\n"
+# Some rule text, a blank line, then a line that is neither a list item nor a header
+# Every bold label, "**Label:**" or "**Label**"; zero-width so adjacent labels sharing "**" are all found
+_BOLD_LABEL_RE = re.compile(r"\*\*(?=([^*\n:]+)(:?)\*\*)")
+_RULES_DONE_RE = re.compile(r"\S.*\n[ \t]*\n\s*(?=(?![-*#\d\s])\S)")
+
+def normalize_headers(text, program, now_str=None):
     """
     Normalize the headers in the use case to match the required template format
     """
+    now_str = now_str or datetime.now().strftime('%m.%d.%Y')
     # Basic cleanups
-    text = re.sub(r"# (.+)", r"**\1**", text)  # Convert main title from markdown to bold
+    text = _MD_H1.sub(r"**\1**", text)  # Convert main title from markdown to bold
     
-    # Ensure all section headers use the correct format
-    sections = [
-        "Identification", "Description", "Pre-Condition", "Post-Condition",
-        "Entities Used / Tables Used", "Process Steps", "Tests Needed", "Business Rules"
-    ]
+    # Replace any variant of section headers with the correct format
+    text = _HEADER_ALT.sub(lambda m: f"**{m.group(1)}:**", text)
     
-    for section in sections:
-        # Replace any variant of section headers with the correct format
-        text = re.sub(rf"##\s+{re.escape(section)}s?", f"**{section}:**", text)
-        text = re.sub(rf"###\s+{re.escape(section)}s?", f"**{section}:**", text)
-        
-        # If the section doesn't exist at all, add it
-        if f"**{section}:**" not in text and section != "Business Rules":
-            text += f"\n\n**{section}:**\n- TBD"
+    # One scan for the labels already present, instead of a substring search per section/field
+    labels = [m.groups() for m in _BOLD_LABEL_RE.finditer(text)]
+    headers = {label for label, colon in labels if colon}
+    bold = {label for label, _ in labels}
+    
+    # If a section doesn't exist at all, add it
+    missing = [s for s in SECTIONS if s != "Business Rules" and s not in headers]
+    if missing:
+        text += "".join(f"\n\n**{s}:**\n- TBD" for s in missing)
     
     # Fix Use Case ID format
-    text = re.sub(r"Use Case ID\*\*: UC-AP-(\d+)-(\d{3})", r"Use Case ID:** UC-AP-\1-\2", text)
+    text = _ID_RE.sub(r"Use Case ID:** UC-AP-\1-\2", text)
     
     # Make sure use case ID is properly formatted with 2-digit sequence numbers
-    text = re.sub(r"Use Case ID\*\*: UC-AP-(\d+)-(\d{3})", 
-                  lambda m: f"Use Case ID:** UC-AP-{m.group(1)}-{int(m.group(2)):02d}", text)
+    text = _ID_RE.sub(lambda m: f"Use Case ID:** UC-AP-{m.group(1)}-{int(m.group(2)):02d}", text)
     
     # Ensure Module Group is present
-    if "**Module Group:**" not in text:
-        text = re.sub(r"(\*\*Use Case ID:\*\* [^\n]+)", 
-                     r"\1\n\n**Module Group:** Accounts Payable", text)
+    if "Module Group" not in headers:
+        text = _ID_LINE_RE.sub(r"\1\n\n**Module Group:** Accounts Payable", text)
     
     # Add other required fields if missing
     required_fields = [
         f"**Legacy Program Ref:** AP{program}.RPG36",
         "**Version**: 1.0",
-        f"**Last Update:** {datetime.now().strftime('%m.%d.%Y')}",
+        f"**Last Update:** {now_str}",
         "**Last Update By:** System Generated",
-        f"**Created:** {datetime.now().strftime('%m.%d.%Y')}",
+        f"**Created:** {now_str}",
         "**Created By:** System Generated",
         "**Approved By**: ?"
     ]
     
     for field in required_fields:
-        if field.split(":")[0] not in text:
+        if field.split(":")[0].strip("*") not in bold:
             # Insert after Identification section
-            text = re.sub(r"(\*\*Module Group:[^\n]+)", 
-                          lambda m: f"{m.group(1)}\n\n{field}", text)
+            text = _MODULE_GROUP_RE.sub(lambda m: f"{m.group(1)}\n\n{field}", text)
     
     return text
 
+REQUIRED_SECTIONS = [
+    "**Use Case ID:**", 
+    "**Module Group:**", 
+    "**Legacy Program Ref:**",
+    "**Description:**", 
+    "**Pre-Condition:**", 
+    "**Post-Condition:**",
+    "**Entities Used / Tables Used:**", 
+    "**Process Steps:**"
+]
+# Text after a section heading, up to the next bold "**Label:**" or the end
+_SECTION_CONTENT_RES = {
+    s: re.compile(f"{re.escape(s)}(.*?)(?=\\*\\*[^:]+:\\*\\*|$)", re.DOTALL) for s in REQUIRED_SECTIONS
+}
+
 def calculate_acceptance_score(text):
     """Calculate a score for how complete/valid the use case is based on the new template format"""
     score = 0
-    required_sections = [
-        "**Use Case ID:**", 
-        "**Module Group:**", 
-        "**Legacy Program Ref:**",
-        "**Description:**", 
-        "**Pre-Condition:**", 
-        "**Post-Condition:**",
-        "**Entities Used / Tables Used:**", 
-        "**Process Steps:**"
-    ]
     
     # Check if there's a title (must be in bold at beginning)
-    if re.search(r"^\*\*[^*]+\*\*", text.strip()):
+    if _TITLE_RE.search(text.strip()):
         score += 0.1
     
     # Check sections
-    for section in required_sections:
+    for section in REQUIRED_SECTIONS:
         if section in text:
             score += 0.1
             
             # Check content in sections (look for text after section heading)
-            pattern = f"{re.escape(section)}(.*?)(?=\*\*[^:]+:\*\*|$)"
-            match = re.search(pattern, text, re.DOTALL)
+            match = _SECTION_CONTENT_RES[section].search(text)
             if match and len(match.group(1).strip()) > 5:  # Some minimal content
                 score += 0.05
     
     return score
 
+_POSTPROCESS_MEMO = {}
+
+def normalize_and_score(result, program, now_str):
+    """normalize_headers + calculate_acceptance_score, memoized on a hash of the raw output"""
+    key = (hashlib.blake2b(result.encode("utf-8"), digest_size=16).digest(), program, now_str)
+    cached = _POSTPROCESS_MEMO.get(key)
+    if cached is None:
+        text = normalize_headers(result, program, now_str)
+        cached = _POSTPROCESS_MEMO[key] = (text, calculate_acceptance_score(text))
+    return cached
+
 def is_valid_output(text):
     """Basic validation to check if this looks like a use case"""
     score = calculate_acceptance_score(text)
@@ -213,7 +491,7 @@ def extract_title(text, program, use_case_counter):
     Extract title for filename based on the template format
     """
     # Get the title from the content - it should be the first bold text
-    title_match = re.search(r"^\*\*([^*]+)\*\*", text.strip())
+    title_match = _TITLE_RE.search(text.strip())
     
     if title_match:
         title = title_match.group(1).strip()
@@ -225,75 +503,158 @@ def extract_title(text, program, use_case_counter):
     id_part = f"{use_case_counter:02d}"
     
     # Clean the title for use in filename
-    clean_title = re.sub(r'[^a-zA-Z0-9\- ]+', '', title).replace(' ', '-')
-    clean_title = re.sub(r'-+', '-', clean_title)
+    clean_title = _FILENAME_CLEAN.sub('', title).replace(' ', '-')
+    clean_title = _DASH_COLLAPSE.sub('-', clean_title)
     
     # Create the filename
     return f"UC-AP-{program}-{id_part}-{clean_title[:40]}"
 
-def save_as_docx(content, path):
-    try:
-        doc = Document()
-        
-        # Process content as paragraphs with proper formatting
-        paragraphs = content.split('\n\n')
+_BOLD_RPR = OxmlElement("w:rPr")
+_BOLD_RPR.append(OxmlElement("w:b"))
+
+def _paragraph(text=None, style_id=None, bold=False):
+    # Build <w:p> directly instead of going through doc.add_paragraph / add_run
+    p = OxmlElement("w:p")
+    if style_id:
+        p_pr = OxmlElement("w:pPr")
+        p_style = OxmlElement("w:pStyle")
+        p_style.set(qn("w:val"), style_id)
+        p_pr.append(p_style)
+        p.append(p_pr)
+    if text:
+        r = OxmlElement("w:r")
+        if bold:
+            r.append(deepcopy(_BOLD_RPR))
+        t = OxmlElement("w:t")
+        t.set(qn("xml:space"), "preserve")
+        t.text = text
+        r.append(t)
+        p.append(r)
+    return p
+
+def _page_break():
+    p = OxmlElement("w:p")
+    r = OxmlElement("w:r")
+    br = OxmlElement("w:br")
+    br.set(qn("w:type"), "page")
+    r.append(br)
+    p.append(r)
+    return p
+
+def _render_usecase(content):
+    """Parse one use case into detached <w:p> elements, ready to be appended to any document body"""
+    elements = []
+    for para in content.split('\n\n'):
+        lines = para.strip().split('\n')
+        first_line = lines[0].strip()
+        header = first_line.replace('**', '').strip()
         
-        for para in paragraphs:
-            lines = para.strip().split('\n')
-            
-            # If this is just a single line
-            if len(lines) == 1:
-                line = lines[0].strip()
-                
-                # Title (in bold)
-                if line.startswith('**') and line.endswith('**') and ':' not in line:
-                    # Remove the asterisks and add as heading
-                    clean_title = line.strip('*').strip()
-                    doc.add_heading(clean_title, level=1)
-                # Section headers
-                elif line.startswith('**') and ':**' in line:
-                    # Remove the asterisks but keep the bold formatting
-                    clean_header = line.replace('**', '').strip()
-                    p = doc.add_paragraph()
-                    p.add_run(clean_header).bold = True
-                # Regular paragraph
-                else:
-                    doc.add_paragraph(line)
-            # Multi-line paragraph
+        # If this is just a single line
+        if len(lines) == 1:
+            # Title (in bold)
+            if first_line.startswith('**') and first_line.endswith('**') and ':' not in first_line:
+                elements.append(_paragraph(first_line.strip('*').strip(), "Heading1"))
+            # Section headers
+            elif first_line.startswith('**') and ':**' in first_line:
+                elements.append(_paragraph(header, bold=True))
+            # Regular paragraph
             else:
-                # Check if first line is a section header
-                first_line = lines[0].strip()
-                if first_line.startswith('**') and ':**' in first_line:
-                    # Remove the asterisks but keep the bold formatting
-                    clean_header = first_line.replace('**', '').strip()
-                    p = doc.add_paragraph()
-                    p.add_run(clean_header).bold = True
-                    
-                    # Add remaining lines as separate paragraphs
-                    for line in lines[1:]:
-                        if line.strip():
-                            if line.strip().startswith('-'):
-                                doc.add_paragraph(line.strip(), style='List Bullet')
-                            else:
-                                doc.add_paragraph(line.strip())
-                else:
-                    # Just a regular multi-line paragraph
-                    p = doc.add_paragraph()
-                    for line in lines:
-                        p.add_run(line + '\n')
-        
+                elements.append(_paragraph(first_line))
+        # Multi-line paragraph starting with a section header
+        elif first_line.startswith('**') and ':**' in first_line:
+            elements.append(_paragraph(header, bold=True))
+            
+            # Add remaining lines as separate paragraphs
+            for line in lines[1:]:
+                if line.strip():
+                    style = "ListBullet" if line.strip().startswith('-') else None
+                    elements.append(_paragraph(line.strip(), style))
+        else:
+            # Just a regular multi-line paragraph: one run with a line break after each line
+            p = _paragraph()
+            r = OxmlElement("w:r")
+            for line in lines:
+                t = OxmlElement("w:t")
+                t.set(qn("xml:space"), "preserve")
+                t.text = line
+                r.append(t)
+                r.append(OxmlElement("w:br"))
+            p.append(r)
+            elements.append(p)
+    return elements
+
+def _append_usecase(body, elements):
+    """Append rendered paragraphs to the document body XML, ahead of the section properties"""
+    anchor = body.sectPr
+    for element in elements:
+        if anchor is not None:
+            anchor.addprevious(element)
+        else:
+            body.append(element)
+
+_io_pool = ThreadPoolExecutor(max_workers=DOCX_WRITERS)
+
+def save_as_docx(content, path, rendered=None):
+    try:
+        elements = _render_usecase(content)
+        if rendered is not None:
+            # Keep the originals for SUMMARY.docx and put copies in this document
+            rendered[content] = elements
+            elements = [deepcopy(e) for e in elements]
+        doc = Document()
+        _append_usecase(doc.element.body, elements)
         doc.save(path)
         return True
     except Exception as e:
         print(f"Error saving Word document: {e}")
         return False
 
+def is_similar(a, b):
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    # quick_ratio() is a cheap upper bound on ratio(), so most non-matches stop there
+    return matcher.quick_ratio() > FUZZY_THRESHOLD and matcher.ratio() > FUZZY_THRESHOLD
+
+def minhash(text):
+    mh = MinHash(num_perm=MINHASH_NUM_PERM)
+    for shingle in {text[i:i + 5] for i in range(max(len(text) - 4, 1))}:
+        mh.update(shingle.encode("utf-8"))
+    return mh
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def exact_dedupe(results):
+    """Drop byte-identical use cases, keeping the first of each"""
+    seen = set()
+    unique = []
+    for r in results:
+        digest = hashlib.blake2b(r.encode("utf-8"), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(r)
+    return unique
+
 def fuzzy_dedupe(results):
-    seen, unique = [], []
+    # Exact copies are cheap to drop; only what's left goes through the fuzzy comparison
+    results = exact_dedupe(results)
+    unique = []
+    if MinHashLSH is not None:
+        # Only use cases in the same LSH buckets are compared with SequenceMatcher, which makes the call
+        lsh = MinHashLSH(threshold=LSH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+        for r in results:
+            mh = minhash(r)
+            if not any(is_similar(r, unique[key]) for key in lsh.query(mh)):
+                lsh.insert(len(unique), mh)
+                unique.append(r)
+        return unique
+
+    seen_tokens = []
     for r in results:
-        if not any(SequenceMatcher(None, r, s).ratio() > FUZZY_THRESHOLD for s in seen):
-            seen.append(r)
+        tokens = set(r.split())
+        if not any(jaccard(tokens, t) > JACCARD_PREFILTER and is_similar(r, s)
+                   for s, t in zip(unique, seen_tokens)):
             unique.append(r)
+            seen_tokens.append(tokens)
     return unique
 
 def format_narrative(text):
@@ -303,12 +664,15 @@ def format_narrative(text):
     # Keep the full text as is - no need to reformat since we're already in the desired format
     return text
 
-def process_chunks(file_path, program):
+def process_chunks(file_path, program, per_chunk_docx=True, per_chunk_md=True, concurrency=OLLAMA_NUM_PARALLEL):
     now = datetime.now()
+    now_str = now.strftime('%m.%d.%Y')  # Same date stamp for every use case from this file
     date_folder = os.path.join(OUTPUT_BASE, f"usecases-{now.strftime('%Y-%m-%d')}")
     timestamp = now.strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join(date_folder, f"{program}_{timestamp}")
-    log_dir = os.path.join("logs", f"logs_{program}_{timestamp}")
+    # Named after the source file, since AP760/AP760P (and others) share a program number and may run together
+    source = os.path.basename(file_path).split(".")[0]
+    output_dir = os.path.join(date_folder, f"{source}_{timestamp}")
+    log_dir = os.path.join("logs", f"logs_{source}_{timestamp}")
     
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(log_dir, exist_ok=True)
@@ -321,59 +685,37 @@ def process_chunks(file_path, program):
     print(f"Processing {file_path} for program AP{program}...")
     
     all_lines = read_lines(file_path)
-    template = open(TEMPLATE_FILE, "r", encoding="utf-8").read()
-    chunks = chunk_lines(all_lines)
+    total = math.ceil(len(all_lines) / (CHUNK_SIZE - CHUNK_OVERLAP))
     
-    print(f"Generated {len(chunks)} chunks to process")
+    print(f"Generated {total} chunks to process")
     
     all_results = []
+    rendered = {}  # use case text -> rendered docx paragraphs, reused for SUMMARY.docx
+    pending_docx = []  # (future, filename) for .docx saves still running; filename is None for low confidence
     failed = []
-    raw_log = []
+    raw_log = io.StringIO()
     use_case_counter = 1  # To ensure sequential numbering starts at 01
+    id_re = re.compile(rf"Use Case ID\*\*: UC-AP-{re.escape(program)}-[^\n]*")
 
-    # Process each chunk
-    for i, chunk in enumerate(chunks):
-        print(f"Processing chunk {i+1}/{len(chunks)}")
-        
-        # Build and run prompt
-        prompt = build_prompt(template, chunk, None, program)
-        
-        # Try primary model first
-        print(f"Trying with {PRIMARY_MODEL}")
-        result = run_ollama(PRIMARY_MODEL, prompt)
-        
-        # Fall back to secondary model if needed
-        if not result:
-            print(f"Falling back to {FALLBACK_MODEL}")
-            result = run_ollama(FALLBACK_MODEL, prompt)
-        
+    # Run all chunks through the model concurrently, then post-process in chunk order
+    # so use case numbering stays sequential
+    system = build_system_prompt(program, now_str)
+    prompts = [build_prompt(chunk) for chunk in chunk_lines(all_lines)]
+    results = run_async(generate_cached(system, prompts, now_str, concurrency))
+
+    for i, result in enumerate(results):
         # Process the result
         if result:
-            # Normalize headers to match template
-            result = normalize_headers(result, program)
-            raw_log.append(f"\n\n# Chunk {i + 1}\n{result}\n{'=' * 50}\n")
-            
-            # Check if it looks valid enough
-            score = calculate_acceptance_score(result)
+            # Normalize headers to match template and check if it looks valid enough
+            result, score = normalize_and_score(result, program, now_str)
+            raw_log.write(f"\n\n# Chunk {i + 1}\n{result}\n{'=' * 50}\n")
             
-            if is_valid_output(result):
+            if score >= MIN_ACCEPTANCE_SCORE:
                 # Make sure Use Case ID is in the right format with 2-digit sequence numbers
                 
-                # Find the ID pattern and replace it with the correctly formatted version
-                id_pattern = f"Use Case ID**: UC-AP-{program}-"
-                id_pattern_index = result.find(id_pattern)
-
-                if id_pattern_index >= 0:
-                    # Find where the ID ends (look for next whitespace or line break)
-                    end_pos = result.find("\n", id_pattern_index)
-                    if end_pos < 0:
-                        end_pos = len(result)
-                    
-                    # Create the new ID string
-                    new_id = f"{id_pattern}{use_case_counter:02d}"
-                    
-                    # Replace just that portion
-                    result = result[:id_pattern_index] + new_id + result[end_pos:]
+                # Replace the first ID, up to the end of its line, with the correctly formatted version
+                new_id = f"Use Case ID**: UC-AP-{program}-{use_case_counter:02d}"
+                result = id_re.sub(lambda m: new_id, result, count=1)
                 
                 # Generate filename with proper format
                 filename = extract_title(result, program, use_case_counter)
@@ -382,37 +724,36 @@ def process_chunks(file_path, program):
                 docx_path = os.path.join(output_dir, f"{filename}.docx")
                 
                 # Save as markdown
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(result)
+                if per_chunk_md:
+                    Path(md_path).write_text(result, encoding="utf-8")
                 
-                # Save as docx
-                if save_as_docx(result, docx_path):
-                    print(f"✅ Created use case: {filename}")
-                    all_results.append(result)
-                    use_case_counter += 1
+                # Save as docx in the background
+                if per_chunk_docx:
+                    pending_docx.append((_io_pool.submit(save_as_docx, result, docx_path, rendered), filename))
                 else:
-                    print(f"⚠️ Created use case markdown but Word doc failed: {filename}")
-                    all_results.append(result)  # Still add it to results
-                    use_case_counter += 1
+                    print(f"✅ Created use case: {filename}")
+                all_results.append(result)  # Still add it to results if the Word doc failed
+                use_case_counter += 1
             else:
                 # For low confidence results, still try to create a use case
                 # Use a clearly marked filename
                 base_filename = f"UC-AP-{program}-{use_case_counter:02d}-Low-Confidence"
                 
                 # Extract any title if possible
-                title_match = re.search(r"^\*\*([^*]+)\*\*", result.strip())
+                title_match = _TITLE_RE.search(result.strip())
                 if title_match:
                     title = title_match.group(1).strip()
-                    clean_title = re.sub(r'[^a-zA-Z0-9\- ]+', '', title).replace(' ', '-')
+                    clean_title = _FILENAME_CLEAN.sub('', title).replace(' ', '-')
                     base_filename = f"UC-AP-{program}-{use_case_counter:02d}-{clean_title[:40]}"
                 
                 md_path = os.path.join(output_dir, f"{base_filename}.md")
                 docx_path = os.path.join(output_dir, f"{base_filename}.docx")
                 
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(result)
+                if per_chunk_md:
+                    Path(md_path).write_text(result, encoding="utf-8")
                     
-                save_as_docx(result, docx_path)
+                if per_chunk_docx:
+                    pending_docx.append((_io_pool.submit(save_as_docx, result, docx_path), None))
                 print(f"⚠️ Created low confidence use case: {base_filename}")
                 use_case_counter += 1
         else:
@@ -423,61 +764,36 @@ def process_chunks(file_path, program):
     print(f"Writing summary files...")
     
     # Raw output log
-    with open(raw_out, "w", encoding="utf-8") as f:
-        f.writelines(raw_log)
+    Path(raw_out).write_text(raw_log.getvalue(), encoding="utf-8")
     
     # Deduped summary
     unique_results = fuzzy_dedupe(all_results)
-    with open(summary_md, "w", encoding="utf-8") as f:
-        for uc in unique_results:
-            f.write(uc + "\n\n" + "=" * 60 + "\n\n")
+    Path(summary_md).write_text("".join(uc + SUMMARY_SEPARATOR for uc in unique_results), encoding="utf-8")
+    
+    # Wait for the per-use-case Word docs; their rendered paragraphs are reused below
+    for future, filename in pending_docx:
+        saved = future.result()
+        if filename is None:
+            continue
+        if saved:
+            print(f"✅ Created use case: {filename}")
+        else:
+            print(f"⚠️ Created use case markdown but Word doc failed: {filename}")
     
     # Summary as Word document
     try:
         if unique_results:
             doc = Document()
+            body = doc.element.body
             for r in unique_results:
-                doc.add_page_break()  # Start each use case on a new page
+                # Start each use case on a new page
+                if body.sectPr is not None:
+                    body.sectPr.addprevious(_page_break())
+                else:
+                    body.append(_page_break())
                 
-                # Parse the use case content
-                paragraphs = r.split('\n\n')
-                for para in paragraphs:
-                    lines = para.strip().split('\n')
-                    
-                    # If this is just a single line
-                    if len(lines) == 1:
-                        line = lines[0].strip()
-                        
-                        # Title (in bold)
-                        if line.startswith('**') and line.endswith('**') and not ':' in line:
-                            doc.add_heading(line.strip('*'), level=1)
-                        # Section headers
-                        elif line.startswith('**') and ':**' in line:
-                            p = doc.add_paragraph()
-                            p.add_run(line).bold = True
-                        # Regular paragraph
-                        else:
-                            doc.add_paragraph(line)
-                    # Multi-line paragraph
-                    else:
-                        # Check if first line is a section header
-                        first_line = lines[0].strip()
-                        if first_line.startswith('**') and ':**' in first_line:
-                            p = doc.add_paragraph()
-                            p.add_run(first_line).bold = True
-                            
-                            # Add remaining lines as separate paragraphs
-                            for line in lines[1:]:
-                                if line.strip():
-                                    if line.strip().startswith('-'):
-                                        doc.add_paragraph(line.strip(), style='List Bullet')
-                                    else:
-                                        doc.add_paragraph(line.strip())
-                        else:
-                            # Just a regular multi-line paragraph
-                            p = doc.add_paragraph()
-                            for line in lines:
-                                p.add_run(line + '\n')
+                elements = rendered.get(r)
+                _append_usecase(body, elements if elements is not None else _render_usecase(r))
             
             doc.save(summary_docx)
     except Exception as e:
@@ -491,32 +807,47 @@ def process_chunks(file_path, program):
     print(f"✅ Done: {len(unique_results)} use cases ({use_case_counter-1} total including low confidence), {len(failed)} failed chunks.")
     return len(unique_results), use_case_counter-1, len(failed)
 
-def run_all():
+def run_all(per_chunk_docx=True, per_chunk_md=True):
     total_success = 0
     total_all = 0
     total_failed = 0
     
     print(f"Starting batch processing of {len(ALL_RPG_FILES)} files...")
+    try:
+        run_async(warmup_models())
+    finally:
+        # Workers keep their own client for all the files they process; it closes with the worker
+        close_client()
     
-    for fname in ALL_RPG_FILES:
-        full_path = os.path.join(SOURCE_DIR, fname)
-        program_match = re.search(r"AP(\d+)", fname.upper())
-        
-        if not program_match:
-            print(f"Skipping {fname}: No AP### match.")
-            continue
+    # Each file worker gets an equal share of the server's slots
+    per_file = max(1, OLLAMA_NUM_PARALLEL // FILE_WORKERS)
+    with ProcessPoolExecutor(max_workers=FILE_WORKERS) as pool:
+        futures = {}
+        for fname in ALL_RPG_FILES:
+            full_path = os.path.join(SOURCE_DIR, fname)
+            program_match = _PROGRAM_RE.search(fname.upper())
             
-        if not os.path.exists(full_path):
-            print(f"❌ File not found: {full_path}")
-            continue
-            
-        program_num = program_match.group(1)
-        print(f"\n{'=' * 60}\nProcessing file: {fname} (AP{program_num})\n{'=' * 60}")
+            if not program_match:
+                print(f"Skipping {fname}: No AP### match.")
+                continue
+                
+            if not os.path.exists(full_path):
+                print(f"❌ File not found: {full_path}")
+                continue
+                
+            program_num = program_match.group(1)
+            print(f"\n{'=' * 60}\nProcessing file: {fname} (AP{program_num})\n{'=' * 60}")
+            futures[pool.submit(process_chunks, full_path, program_num, per_chunk_docx, per_chunk_md, per_file)] = fname
         
-        success, all_count, failed = process_chunks(full_path, program_num)
-        total_success += success
-        total_all += all_count
-        total_failed += failed
+        for future in as_completed(futures):
+            try:
+                success, all_count, failed = future.result()
+            except Exception as e:
+                print(f"❌ Error processing {futures[future]}: {e}")
+                continue
+            total_success += success
+            total_all += all_count
+            total_failed += failed
     
     print(f"\n{'=' * 60}")
     print(f"BATCH PROCESSING COMPLETE")
@@ -530,14 +861,24 @@ if __name__ == "__main__":
     os.makedirs(OUTPUT_BASE, exist_ok=True)
     os.makedirs("logs", exist_ok=True)
     
+    # --skip-per-chunk-docx: only SUMMARY.docx is written, not one .docx per use case
+    # --summary-only: no per-use-case files at all, just the SUMMARY/RAW/FAILED outputs
+    per_chunk_md = "--summary-only" not in sys.argv
+    per_chunk_docx = per_chunk_md and "--skip-per-chunk-docx" not in sys.argv
+    file_args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    
     if "--all" in sys.argv:
-        run_all()
-    elif len(sys.argv) >= 2:
-        file_arg = sys.argv[1]
-        program_match = re.search(r"AP(\d+)", file_arg.upper())
+        run_all(per_chunk_docx, per_chunk_md)
+    elif file_args:
+        file_arg = file_args[0]
+        program_match = _PROGRAM_RE.search(file_arg.upper())
         if not program_match:
             print("❌ Invalid file name. Must include AP###.")
             sys.exit(1)
-        process_chunks(file_arg, program_match.group(1))
+        try:
+            run_async(warmup_models())
+            process_chunks(file_arg, program_match.group(1), per_chunk_docx, per_chunk_md)
+        finally:
+            close_client()
     else:
-        print("Usage: python analyze_rpg_usecases_final_batch.py [filename] or --all")
\ No newline at end of file
+        print("Usage: python analyze_rpg_usecases_final_batch.py [filename] or --all [--skip-per-chunk-docx | --summary-only]")
\ No newline at end of file
@@ -1,12 +1,42 @@
+import asyncio
+import hashlib
+import io
+import json
+import math
 import os
 import re
 import sys
 import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from difflib import SequenceMatcher
-import subprocess
+from functools import lru_cache
+from pathlib import Path
+from xml.sax.saxutils import escape
+import httpx
 from docx import Document
 
+try:
+    from datasketch import MinHash, MinHashLSH
+except ImportError:  # pip install datasketch; without it every result is compared with SequenceMatcher
+    MinHash = MinHashLSH = None
+
+try:
+    import ahocorasick
+except ImportError:  # pip install pyahocorasick; otherwise one regex alternation does the header pass
+    ahocorasick = None
+
+try:
+    from vllm import LLM, SamplingParams
+except ImportError:  # pip install vllm; only needed with RPG_BACKEND=vllm
+    LLM = SamplingParams = None
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # pip install rapidfuzz; otherwise difflib's SequenceMatcher does the comparisons
+    fuzz = process = None
+
 # === CONFIGURATION ===
 PRIMARY_MODEL = "mistral:7b-instruct"
 FALLBACK_MODEL = "codellama:13b-instruct-q4_K_M"
@@ -14,10 +44,35 @@ TIMEOUT = 60  # Reduced timeout for faster processing
 CHUNK_SIZE = 90  # Original size
 CHUNK_OVERLAP = 30  # Original overlap
 FUZZY_THRESHOLD = 0.94
+MINHASH_NUM_PERM = 128
+# Estimated word-bigram overlap for a pair to get the full SequenceMatcher comparison. Pairs above
+# FUZZY_THRESHOLD have bigram Jaccard of ~0.75 or more, so 0.5 keeps LSH from missing them
+LSH_THRESHOLD = 0.5
 TEMPLATE_FILE = "use_case_template.md"
 OUTPUT_BASE = "use_case_outputs"
 INCLUDE_AP200 = False  # Simplified - no extra context
 MIN_ACCEPTANCE_SCORE = 0.5  # Threshold for accepting use cases even if not perfect
+OLLAMA_URL = "http://127.0.0.1:11434"  # Loopback IP, so each new connection skips a localhost lookup (and a ::1 attempt on Windows)
+OLLAMA_KEEP_ALIVE = "30m"  # Keep the model loaded between chunks
+# Requests in flight at once across all file workers; start the Ollama server with OLLAMA_NUM_PARALLEL of at least this.
+# --all splits it between the files, so a request is never left queueing on the server into its TIMEOUT
+OLLAMA_CONCURRENCY = 4
+QUEUE_SIZE = 8  # Prompts built ahead of the workers
+OLLAMA_CACHE_DIR = Path(".cache") / "ollama"  # sha256(backend, model, prompt).json -> model output; delete to regenerate
+# "ollama" (HTTP server) or "vllm" (in-process engine that batches prompts on one forward pass)
+BACKEND = os.getenv("RPG_BACKEND", "ollama")
+VLLM_MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+VLLM_MAX_BATCH = 16  # Prompts per vLLM generate call
+VLLM_FLUSH_WINDOW = 0.05  # Seconds to wait for a batch to fill before sending what has arrived
+VLLM_MAX_TOKENS = 1024
+# Files processed at once with --all; each works through its own chunks while the others wait on Ollama.
+# vLLM keeps its model on the GPU inside the process, so only one file worker can run with it
+FILE_WORKERS = 1 if BACKEND == "vllm" else min(4, os.cpu_count() or 1, OLLAMA_CONCURRENCY)
+IO_WRITERS = 4  # Threads writing per-use-case .md/.docx files while the next chunks run through the model
+# Skip chunks naming fewer than KEYWORD_MIN_HITS distinct business identifiers (see _KEYWORD_RE) instead of
+# sending them to the model; skipped chunks are listed in FAILED_CHUNKS.txt
+KEYWORD_PREFILTER = True
+KEYWORD_MIN_HITS = 2
 
 # === ALL FILES TO PROCESS ===
 ALL_RPG_FILES = [
@@ -30,17 +85,27 @@ ALL_RPG_FILES = [
 SOURCE_DIR = r"C:\Temp\IBM-GitHub-Submission-Unedited\IBM-GitHub-Submission\QSRC"
 
 def read_lines(path):
+    data = Path(path).read_bytes()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return [line.rstrip("\n") for line in f.readlines()]
+        text = data.decode("utf-8")
     except UnicodeDecodeError:
-        # Fallback to another encoding if utf-8 fails
-        with open(path, "r", encoding="latin-1") as f:
-            return [line.rstrip("\n") for line in f.readlines()]
+        # Fallback to another encoding if utf-8 fails; same bytes, no second read
+        text = data.decode("latin-1")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")  # The newline handling read_text did
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()  # Trailing newline, not an extra empty line
+    return lines
 
 def chunk_lines(lines, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     step = size - overlap
-    return ['\n'.join(lines[i:i + size]) for i in range(0, len(lines), step)]
+    for i in range(0, len(lines), step):
+        yield '\n'.join(lines[i:i + size])
+
+@lru_cache(maxsize=None)
+def _template():
+    return Path(TEMPLATE_FILE).read_text(encoding="utf-8")
 
 def build_prompt(template, chunk, context=None, program="XXX"):
     context_block = f"\nReference context from AP200 (not primary logic):\n{context}\n" if context else ""
@@ -61,41 +126,296 @@ IMPORTANT REQUIREMENTS:
 [END CODE]
 """
 
-def run_ollama(model, prompt):
+async def run_ollama(client, model, prompt):
     try:
-        result = subprocess.run(
-            ["ollama", "run", model],
-            input=prompt.encode(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=TIMEOUT
-        )
-        return result.stdout.decode().strip()
-    except subprocess.TimeoutExpired:
+        resp = await client.post("/api/generate", json={
+            "model": model, "prompt": prompt, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE
+        })
+        resp.raise_for_status()
+        return resp.json().get("response", "").strip()
+    except httpx.TimeoutException:
         print(f"Timeout using {model}")
         return None
     except Exception as e:
         print(f"Error running ollama: {e}")
         return None
 
+class OllamaBackend:
+    """One HTTP request per prompt; the server runs up to OLLAMA_NUM_PARALLEL of them together"""
+    primary, fallback = PRIMARY_MODEL, FALLBACK_MODEL
+    cache_tag = f"ollama:{PRIMARY_MODEL}"
+
+    def __init__(self, concurrency=OLLAMA_CONCURRENCY):
+        self.concurrency = concurrency
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(base_url=OLLAMA_URL, timeout=httpx.Timeout(TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    async def generate(self, model, prompt):
+        return await run_ollama(self.client, model, prompt)
+
+@lru_cache(maxsize=None)
+def _vllm_engine():
+    return LLM(model=VLLM_MODEL)
+
+class VLLMBackend:
+    """
+    Prompts arriving within VLLM_FLUSH_WINDOW (up to VLLM_MAX_BATCH) go to the engine as one
+    generate call, so their decoding shares forward passes. There's a single model, so no fallback.
+    """
+    concurrency = VLLM_MAX_BATCH
+    primary, fallback = VLLM_MODEL, None
+    cache_tag = f"vllm:{VLLM_MODEL}"
+
+    async def __aenter__(self):
+        if LLM is None:
+            raise RuntimeError("RPG_BACKEND=vllm needs the vllm package (pip install vllm)")
+        # Loading the model takes a while; off the event loop, and once per process
+        self.engine = await asyncio.to_thread(_vllm_engine)
+        self.pending = []  # (prompt, future) waiting for the next batch
+        self.timer = None
+        self.lock = asyncio.Lock()  # The engine runs one batch at a time
+        self.params = SamplingParams(temperature=0, max_tokens=VLLM_MAX_TOKENS)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.flush()
+
+    async def generate(self, model, prompt):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((prompt, future))
+        if len(self.pending) >= VLLM_MAX_BATCH:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(VLLM_FLUSH_WINDOW, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        async with self.lock:
+            try:
+                # chat() applies the model's instruct template, as Ollama's /api/generate does.
+                # It blocks while the GPU works; a thread keeps the queue moving meanwhile
+                conversations = [[{"role": "user", "content": p}] for p, _ in batch]
+                outputs = await asyncio.to_thread(self.engine.chat, conversations, self.params)
+                texts = [out.outputs[0].text.strip() for out in outputs]
+            except Exception as e:
+                print(f"Error running vLLM: {e}")
+                texts = [None] * len(batch)
+        for (_, future), text in zip(batch, texts):
+            future.set_result(text)
+
+_ensured_dirs = set()
+
+def ensure_dir(path):
+    """os.makedirs once per directory per process; cache_put calls this for every chunk"""
+    path = str(path)
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+def cache_path(tag, prompt):
+    # tag names the backend and model, so switching RPG_BACKEND doesn't reuse the other one's answers
+    digest = hashlib.sha256(f"{tag}\0{prompt}".encode("utf-8")).hexdigest()
+    return OLLAMA_CACHE_DIR / f"{digest}.json"
+
+def cache_get(tag, prompt):
+    try:
+        return json.loads(cache_path(tag, prompt).read_text(encoding="utf-8"))["output"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def cache_put(tag, prompt, model, output):
+    path = cache_path(tag, prompt)
+    # Write to a temp file and rename, so a reader (or another worker) never sees half a file
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        ensure_dir(path.parent)
+        tmp.write_text(json.dumps({"model": model, "output": output}), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        # e.g. the target held open by another process on Windows; the result is still used, just not cached
+        print(f"⚠️ Could not cache output: {e}")
+
+async def generate_all(prompts, total, on_result, concurrency=OLLAMA_CONCURRENCY):
+    """
+    Feed (chunk index, prompt) pairs through a bounded queue to the backend's workers
+    and call on_result(i, result) in chunk order as soon as each result can be released.
+    concurrency is this file's share of the Ollama slots.
+    """
+    backend = VLLMBackend() if BACKEND == "vllm" else OllamaBackend(concurrency)
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    done = asyncio.Queue()
+
+    async def produce():
+        for item in enumerate(prompts):
+            await queue.put(item)
+        for _ in range(backend.concurrency):
+            await queue.put(None)  # One stop signal per worker
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            seq, (i, prompt) = item
+            try:
+                result = await answer(i, prompt)
+            except Exception as e:
+                # Counted as a failed chunk rather than stopping this worker
+                print(f"Error on chunk {i+1}: {e}")
+                result = None
+            await done.put((seq, i, result))
+
+    async def answer(i, prompt):
+        # Same prompt answered before, in this run or an earlier one
+        result = cache_get(backend.cache_tag, prompt)
+        if result is not None:
+            print(f"Chunk {i+1}/{total} answered from cache")
+            return result
+        print(f"Processing chunk {i+1}/{total}")
+        
+        # Try primary model first
+        model = backend.primary
+        result = await backend.generate(model, prompt)
+        
+        # Fall back to secondary model if needed
+        if not result and backend.fallback:
+            print(f"Falling back to {backend.fallback} for chunk {i+1}")
+            model = backend.fallback
+            result = await backend.generate(model, prompt)
+        if result:
+            cache_put(backend.cache_tag, prompt, model, result)
+        return result
+
+    async def finish(workers):
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await done.put(None)  # Always, so the loop below can't wait forever
+
+    async with backend:
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(consume()) for _ in range(backend.concurrency)]
+        finisher = asyncio.create_task(finish(workers))
+        
+        # Results finish out of order; each is held only until the chunks queued before it are handled
+        held, next_seq = {}, 0
+        while (item := await done.get()) is not None:
+            seq, i, result = item
+            held[seq] = (i, result)
+            while next_seq in held:
+                on_result(*held.pop(next_seq))
+                next_seq += 1
+        await asyncio.gather(producer, finisher)
+
+# === PRECOMPILED PATTERNS ===
+HEADER_REPLACEMENTS = [
+    ("## Input Validation", "## Input Type Validation Checks"),
+    ("## Validation Rules", "## Input Type Validation Checks"),
+    ("## Entities Used", "## Entities Used / Tables Used"),
+    ("## Tables Used", "## Entities Used / Tables Used")
+]
+_HEADER_FIXES = dict(HEADER_REPLACEMENTS)
+_HEADER_ALT_RE = re.compile("|".join(re.escape(wrong) for wrong, _ in HEADER_REPLACEMENTS))
+if ahocorasick is not None:
+    _HEADER_AC = ahocorasick.Automaton()
+    for wrong, correct in HEADER_REPLACEMENTS:
+        _HEADER_AC.add_word(wrong, (len(wrong), correct))
+    _HEADER_AC.make_automaton()
+else:
+    _HEADER_AC = None
+REQUIRED_SECTIONS = [
+    "Use Case ID", 
+    "## Description", 
+    "## Pre-Condition", 
+    "## Post-Condition",
+    "## Entities Used / Tables Used", 
+    "## Program Steps", 
+    "## Tests Needed"
+]
+NARRATIVE_HEADERS = ["Identification", "Description", "Pre-Condition", "Post-Condition",
+                     "Entities Used / Tables Used", "Program Steps", "Tests Needed"]
+_ID_NO_PROGRAM_RE = re.compile(r"(Use Case ID\*\*: UC-AP)-(\d+)")
+_TITLE_START_RE = re.compile(r"^#\s+", re.MULTILINE)
+_TITLE_SCORE_RE = re.compile(r"^#\s+.{5,}", re.MULTILINE)
+_TITLE_RE = re.compile(r"(?i)^#\s+(.*?)$", re.MULTILINE)
+_ID_NUMBER_RE = re.compile(r"Use Case ID.*?UC-AP.*?-(\d+)")
+_DESCRIPTION_RE = re.compile(r"##\s+Description\s+(.*?)(?=\n##|$)", re.DOTALL)
+_FILENAME_CLEAN = re.compile(r'[^a-zA-Z0-9\- ]+')  # Only needed for non-ASCII titles
+# ASCII punctuation dropped and spaces turned into hyphens in one str.translate pass
+_FILENAME_TABLE = str.maketrans(" ", "-", "".join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c in "- ")))
+_FILENAME_ID_RE = re.compile(r"UC-AP-\d+-\d{3}-")
+_PROGRAM_RE = re.compile(r"AP(\d+)")
+# One line of a use case: "## " / "### " heading, a "**Label**:" field split at its first colon, or plain text
+_LINE_RE = re.compile(r"^(?:(## )|(### )|(?=\*\*)(?=.*\*\*:)([^:\n]*):)?(.*)$", re.MULTILINE)
+_OTHER_BREAKS_RE = re.compile("[\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]")  # Line breaks for splitlines() besides \n
+_XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")  # Not allowed in a docx part
+# Identifiers starting with a business stem, optionally after an AP file prefix or the spec letter fixed-form
+# source puts against them (FAPVEND): RPG36 names are short abbreviations (VCHNO, INVAMT, CHKNO, GLACCT).
+# Anchored so "position" or "signal" don't count
+_KEYWORD_RE = re.compile(
+    r"\b[CEFIO]?(?:AP)?(?:VCH|VOUCH|INV|PAY|PMT|CHK|CHECK|REMIT|VND|VEND|GL|JRN|JOURNAL|POST|1099)[A-Z0-9#@$]*",
+    re.IGNORECASE,
+)
+# Any required section, so one scan finds them all
+_SECTION_ALT_RE = re.compile("|".join(re.escape(s) for s in REQUIRED_SECTIONS))
+# Any narrative header, so one scan finds them all
+_NARR_RE = re.compile(r"##+\s+(" + "|".join(re.escape(h) for h in NARRATIVE_HEADERS) + ")")
+
+@lru_cache(maxsize=None)
+def _program_patterns(program):
+    """ID patterns that include the program number, compiled once per program"""
+    return (
+        re.compile(rf"(Use Case ID\*\*: UC-AP-{re.escape(program)}-)([^0-9])"),  # ID missing its sequence number
+        # ID to renumber; takes every "-digits" group, so the "UC-AP-760-760-007" left by the
+        # program fix above becomes a single "UC-AP-760-001"
+        re.compile(rf"(Use Case ID\*\*: UC-AP-{re.escape(program)}-)\d+(?:-\d+)*"),
+    )
+
+def replace_headers(text):
+    """
+    Every HEADER_REPLACEMENTS variant rewritten in one pass. The variants don't overlap, and no
+    replacement contains a variant that comes later in the list, so this matches applying them one
+    by one in order. That depends on the order: "## Entities Used / Tables Used" contains
+    "## Entities Used", which is safe only because that replacement has already run. Like the
+    sequential version, an existing "## Entities Used / Tables Used" still gets expanded.
+    """
+    if _HEADER_AC is None:
+        return _HEADER_ALT_RE.sub(lambda m: _HEADER_FIXES[m.group()], text)
+    out, pos = [], 0
+    for end, (length, correct) in _HEADER_AC.iter(text):
+        start = end - length + 1
+        if start < pos:
+            continue
+        out.append(text[pos:start])
+        out.append(correct)
+        pos = end + 1
+    out.append(text[pos:])
+    return "".join(out)
+
 def normalize_headers(text, program):
     # Basic header normalization
-    replacements = {
-        "## Input Validation": "## Input Type Validation Checks",
-        "## Validation Rules": "## Input Type Validation Checks",
-        "## Entities Used": "## Entities Used / Tables Used",
-        "## Tables Used": "## Entities Used / Tables Used"
-    }
-    
-    for wrong, correct in replacements.items():
-        text = text.replace(wrong, correct)
+    text = replace_headers(text)
     
     # Fix Use Case ID format and ensure it follows correct pattern
-    text = re.sub(r"(Use Case ID\*\*: UC-AP)-(\d+)", rf"\1-{program}-\2", text)
-    text = re.sub(r"(Use Case ID\*\*: UC-AP-{program}-)([^0-9])", r"\1001\2", text)
+    text = _ID_NO_PROGRAM_RE.sub(rf"\1-{program}-\2", text)
+    text = _program_patterns(program)[0].sub(r"\g<1>001\g<2>", text)
     
     # Make sure there's a title at the beginning if missing
-    if not re.search(r"^#\s+", text, re.MULTILINE):
+    if not _TITLE_START_RE.search(text):
         text = "# AP" + program + " Use Case\n" + text
         
     return text
@@ -103,30 +423,27 @@ def normalize_headers(text, program):
 def calculate_acceptance_score(text):
     """Calculate a score for how complete/valid the use case is"""
     score = 0
-    required_sections = [
-        "Use Case ID", 
-        "## Description", 
-        "## Pre-Condition", 
-        "## Post-Condition",
-        "## Entities Used / Tables Used", 
-        "## Program Steps", 
-        "## Tests Needed"
-    ]
+    
+    # Where each section's first occurrence ends, from a single scan
+    found = {}
+    for m in _SECTION_ALT_RE.finditer(text):
+        found.setdefault(m.group(), m.end())
     
     # Check sections
-    for section in required_sections:
-        if section in text:
+    for section in REQUIRED_SECTIONS:
+        if section in found:
             score += 0.1
             
-            # Check content in sections except ID
+            # Check content in sections except ID: everything up to the next "## " heading
             if section != "Use Case ID":
-                pattern = f"{section}(.*?)(?=\n## |$)"
-                match = re.search(pattern, text, re.DOTALL)
-                if match and len(match.group(1).strip()) > 10:  # Some minimal content
+                start = found[section]
+                end = text.find("\n## ", start)
+                content = text[start:end] if end >= 0 else text[start:]
+                if len(content.strip()) > 10:  # Some minimal content
                     score += 0.05
     
     # Check for title
-    if re.search(r"^#\s+.{5,}", text, re.MULTILINE):
+    if _TITLE_SCORE_RE.search(text):
         score += 0.1
         
     return score
@@ -136,87 +453,180 @@ def is_valid_output(text):
     score = calculate_acceptance_score(text)
     return score >= MIN_ACCEPTANCE_SCORE
 
+def clean_filename(title):
+    cleaned = title.translate(_FILENAME_TABLE)
+    if not cleaned.isascii():
+        cleaned = _FILENAME_CLEAN.sub('', cleaned)
+    return cleaned
+
 def extract_title(text, program):
     # Try to get the ID number
-    match_id = re.search(r"Use Case ID.*?UC-AP.*?-(\d+)", text)
+    match_id = _ID_NUMBER_RE.search(text)
     id_part = match_id.group(1).zfill(3) if match_id else "001"
     
     # Try to get a title from the content
-    title_match = re.search(r"(?i)^#\s+(.*?)$", text, re.MULTILINE)
+    title_match = _TITLE_RE.search(text)
     if title_match:
         title = title_match.group(1).strip()
     else:
         # If no title, look for description
-        desc_match = re.search(r"##\s+Description\s+(.*?)(?=\n##|$)", text, re.DOTALL)
+        desc_match = _DESCRIPTION_RE.search(text)
         title = desc_match.group(1).strip()[:50] if desc_match else "Use-Case"
     
     # Clean the title for use in filename
-    clean_title = re.sub(r'[^a-zA-Z0-9\- ]+', '', title).replace(' ', '-')
+    clean_title = clean_filename(title)
     return f"UC-AP-{program}-{id_part}-{clean_title[:50]}"
 
+@lru_cache(maxsize=None)
+def _docx_skeleton():
+    """
+    The parts of an empty python-docx document, built once. document.xml is returned
+    as the text before and after its body content so new paragraphs can go in between.
+    """
+    buf = io.BytesIO()
+    Document().save(buf)
+    with zipfile.ZipFile(buf) as zf:
+        parts = [(name, zf.read(name)) for name in zf.namelist()]
+    xml = dict(parts)["word/document.xml"].decode("utf-8")
+    body = xml.index("<w:body>") + len("<w:body>")
+    sect = xml.index("<w:sectPr", body)
+    return parts, xml[:body], xml[sect:]
+
+def _run(text, bold=False):
+    if not text:
+        return ""
+    if _XML_INVALID_RE.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    rpr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    # Tabs are their own element in a run, as python-docx writes them
+    body = "<w:tab/>".join(f'<w:t xml:space="preserve">{escape(t)}</w:t>' if t else "" for t in text.split("\t"))
+    return f"<w:r>{rpr}{body}</w:r>"
+
+def _para(runs="", style=None):
+    ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    return f"<w:p>{ppr}{runs}</w:p>"
+
+def _write_docx(path, paragraphs):
+    """Write paragraph XML into a copy of the empty document skeleton in one zip pass"""
+    parts, head, tail = _docx_skeleton()
+    document = (head + "".join(paragraphs) + tail).encode("utf-8")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in parts:
+            zf.writestr(name, document if name == "word/document.xml" else data)
+
+def write_md(path, content):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
 def save_as_docx(content, path):
     try:
-        doc = Document()
+        paragraphs = []
         
         # Extract title for first heading
-        title_match = re.search(r"(?i)^#\s+(.*?)$", content, re.MULTILINE)
+        title_match = _TITLE_RE.search(content)
         if title_match:
             title = title_match.group(1).strip()
-            doc.add_heading(title, level=1)
+            paragraphs.append(_para(_run(title), "Heading1"))
         
-        # Process rest of content as paragraphs and headings
-        lines = content.splitlines()
-        for i, line in enumerate(lines):
-            if i == 0 and line.startswith("# "):
+        # Process rest of content as paragraphs and headings, one regex scan over all lines
+        has_lines = bool(content)
+        if _OTHER_BREAKS_RE.search(content):
+            content = "\n".join(content.splitlines())  # Same lines splitlines() would give
+        elif content.endswith("\n"):
+            content = content[:-1]
+        for m in _LINE_RE.finditer(content) if has_lines else ():
+            h2, h3, label, text = m.groups()
+            if m.start() == 0 and content.startswith("# "):
                 continue  # Skip title, already added above
                 
-            if line.startswith("## "):
-                doc.add_heading(line[3:], level=2)
-            elif line.startswith("### "):
-                doc.add_heading(line[4:], level=3)
-            elif line.startswith("**") and "**:" in line:
+            if h2:
+                paragraphs.append(_para(_run(text), "Heading2"))
+            elif h3:
+                paragraphs.append(_para(_run(text), "Heading3"))
+            elif label is not None:
                 # Field labels like "**Use Case ID**:"
-                parts = line.split(":", 1)
-                if len(parts) == 2:
-                    p = doc.add_paragraph()
-                    p.add_run(parts[0].strip() + ":").bold = True
-                    p.add_run(parts[1])
+                paragraphs.append(_para(_run(label.strip() + ":", bold=True) + _run(text)))
             else:
-                doc.add_paragraph(line)
+                paragraphs.append(_para(_run(text)))
         
-        doc.save(path)
+        _write_docx(path, paragraphs)
         return True
     except Exception as e:
         print(f"Error saving Word document: {e}")
         return False
 
+def minhash(text):
+    words = text.split()
+    mh = MinHash(num_perm=MINHASH_NUM_PERM)
+    # Word bigrams; a one-word text is a single shingle
+    for i in range(max(len(words) - 1, 1)):
+        mh.update(" ".join(words[i:i + 2]).encode("utf-8"))
+    return mh
+
+def is_similar(a, b):
+    if fuzz is not None:
+        return fuzz.ratio(a, b) / 100.0 > FUZZY_THRESHOLD
+    return SequenceMatcher(None, a, b).ratio() > FUZZY_THRESHOLD
+
 def fuzzy_dedupe(results):
-    seen, unique = [], []
+    # Exact copies are dropped by hash before any fuzzy comparison
+    exact, distinct = set(), []
     for r in results:
-        if not any(SequenceMatcher(None, r, s).ratio() > FUZZY_THRESHOLD for s in seen):
-            seen.append(r)
-            unique.append(r)
+        digest = hashlib.md5(r.encode("utf-8")).hexdigest()
+        if digest not in exact:
+            exact.add(digest)
+            distinct.append(r)
+    
+    unique = []
+    if MinHashLSH is not None:
+        # Only results sharing LSH bands with this one are compared
+        lsh = MinHashLSH(threshold=LSH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+        for r in distinct:
+            mh = minhash(r)
+            if not any(is_similar(r, unique[key]) for key in lsh.query(mh)):
+                lsh.insert(len(unique), mh)
+                unique.append(r)
+    elif process is not None:
+        # All pairs at once in C across every core; keep a result unless an earlier kept one matches it
+        scores = process.cdist(distinct, distinct, scorer=fuzz.ratio, workers=-1)
+        kept = []
+        for i, r in enumerate(distinct):
+            if not any(scores[i][j] / 100.0 > FUZZY_THRESHOLD for j in kept):
+                kept.append(i)
+                unique.append(r)
+    else:
+        for r in distinct:
+            if not any(is_similar(r, s) for s in unique):
+                unique.append(r)
     return unique
 
 def format_narrative(text):
-    headers = ["Identification", "Description", "Pre-Condition", "Post-Condition",
-               "Entities Used / Tables Used", "Program Steps", "Tests Needed"]
+    # Where each header's first occurrence ends, from a single scan
+    found = {}
+    for m in _NARR_RE.finditer(text):
+        found.setdefault(m.group(1), m.end())
+    
     result = ["Use Case Template\n"]
-    for h in headers:
-        m = re.search(f"##+\s+{re.escape(h)}(.*?)(?=\n## |$)", text, re.DOTALL)
-        if m:
-            result.append(f"### {h}\n{m.group(1).strip()}\n")
+    for h in NARRATIVE_HEADERS:
+        if h in found:
+            # The section runs up to the next "## " heading
+            start = found[h]
+            end = text.find("\n## ", start)
+            body = text[start:end] if end >= 0 else text[start:]
+            result.append(f"### {h}\n{body.strip()}\n")
     return "\n".join(result)
 
-def process_chunks(file_path, program):
+def process_chunks(file_path, program, concurrency=OLLAMA_CONCURRENCY):
     now = datetime.now()
     date_folder = os.path.join(OUTPUT_BASE, f"usecases-{now.strftime('%Y-%m-%d')}")
     timestamp = now.strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join(date_folder, f"{program}_{timestamp}")
-    log_dir = os.path.join("logs", f"logs_{program}_{timestamp}")
+    # Named after the source file, since AP760/AP760P (and others) share a program number and may run together
+    source = os.path.basename(file_path).split(".")[0]
+    output_dir = os.path.join(date_folder, f"{source}_{timestamp}")
+    log_dir = os.path.join("logs", f"logs_{source}_{timestamp}")
     
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(log_dir, exist_ok=True)
+    ensure_dir(output_dir)
+    ensure_dir(log_dir)
 
     raw_out = os.path.join(output_dir, "RAW_OLLAMA_OUTPUT.md")
     summary_md = os.path.join(output_dir, "SUMMARY.md")
@@ -226,32 +636,22 @@ def process_chunks(file_path, program):
     print(f"Processing {file_path} for program AP{program}...")
     
     all_lines = read_lines(file_path)
-    template = open(TEMPLATE_FILE, "r", encoding="utf-8").read()
-    chunks = chunk_lines(all_lines)
+    template = _template()
+    total = math.ceil(len(all_lines) / (CHUNK_SIZE - CHUNK_OVERLAP))
     
-    print(f"Generated {len(chunks)} chunks to process")
+    print(f"Generated {total} chunks to process")
     
     all_results = []
     failed = []
+    skipped = []
     raw_log = []
     use_case_counter = 1  # To ensure sequential numbering
+    # Results are handled on the event loop, so file writes go to threads instead of holding up the next call
+    io_pool = ThreadPoolExecutor(max_workers=IO_WRITERS)
+    pending_saves = []  # (md future, docx future, filename, low confidence) for writes still running
 
-    # Process each chunk
-    for i, chunk in enumerate(chunks):
-        print(f"Processing chunk {i+1}/{len(chunks)}")
-        
-        # Build and run prompt
-        prompt = build_prompt(template, chunk, None, program)
-        
-        # Try primary model first
-        print(f"Trying with {PRIMARY_MODEL}")
-        result = run_ollama(PRIMARY_MODEL, prompt)
-        
-        # Fall back to secondary model if needed
-        if not result:
-            print(f"Falling back to {FALLBACK_MODEL}")
-            result = run_ollama(FALLBACK_MODEL, prompt)
-        
+    def handle(i, result):
+        nonlocal use_case_counter
         # Process the result
         if result:
             # Normalize headers
@@ -261,59 +661,74 @@ def process_chunks(file_path, program):
             # Check if it looks valid enough
             score = calculate_acceptance_score(result)
             
-            if is_valid_output(result):
+            if score >= MIN_ACCEPTANCE_SCORE:
                 # Make sure Use Case ID is in the right format with sequential numbering
-                result = re.sub(r"(Use Case ID\*\*: UC-AP-{program}-)\d+", 
-                              rf"\1{str(use_case_counter).zfill(3)}", result)
+                result = _program_patterns(program)[1].sub(rf"\g<1>{str(use_case_counter).zfill(3)}", result)
                 
                 # Generate filename with proper format: UC-AP-160-001-Create-Voucher.docx
                 filename = extract_title(result, program)
                 
                 # If the filename doesn't have a good ID, fix it
-                if not re.search(r"UC-AP-\d+-\d{3}-", filename):
+                if not _FILENAME_ID_RE.search(filename):
                     filename = f"UC-AP-{program}-{str(use_case_counter).zfill(3)}-Use-Case"
                 
                 md_path = os.path.join(output_dir, f"{filename}.md")
                 docx_path = os.path.join(output_dir, f"{filename}.docx")
                 
-                # Save as markdown
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(result)
-                
-                # Save as docx with better error handling
-                if save_as_docx(result, docx_path):
-                    print(f"✅ Created use case: {filename}")
-                    all_results.append(result)
-                    use_case_counter += 1
-                else:
-                    print(f"⚠️ Created use case markdown but Word doc failed: {filename}")
-                    all_results.append(result)  # Still add it to results
-                    use_case_counter += 1
+                # Save as markdown and docx; the outcome is reported once the saves finish
+                pending_saves.append((io_pool.submit(write_md, md_path, result),
+                                      io_pool.submit(save_as_docx, result, docx_path), filename, False))
+                all_results.append(result)
+                use_case_counter += 1
             else:
                 # For low confidence results, still try to extract title and save as regular use case
                 # with a "Low-Confidence" prefix so they're easily identifiable
                 base_filename = f"UC-AP-{program}-{str(use_case_counter).zfill(3)}-Low-Confidence"
                 
                 # If we can extract better title, use it
-                title_match = re.search(r"(?i)^#\s+(.*?)$", result, re.MULTILINE)
+                title_match = _TITLE_RE.search(result)
                 if title_match:
                     title = title_match.group(1).strip()
-                    clean_title = re.sub(r'[^a-zA-Z0-9\- ]+', '', title).replace(' ', '-')
+                    clean_title = clean_filename(title)
                     base_filename = f"UC-AP-{program}-{str(use_case_counter).zfill(3)}-{clean_title[:40]}"
                 
                 md_path = os.path.join(output_dir, f"{base_filename}.md")
                 docx_path = os.path.join(output_dir, f"{base_filename}.docx")
                 
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(result)
-                    
-                save_as_docx(result, docx_path)
-                print(f"⚠️ Created low confidence use case: {base_filename}")
+                pending_saves.append((io_pool.submit(write_md, md_path, result),
+                                      io_pool.submit(save_as_docx, result, docx_path), base_filename, True))
                 use_case_counter += 1
         else:
             print(f"❌ Failed to process chunk {i+1}")
             failed.append(i + 1)
     
+    def prompts():
+        for i, chunk in enumerate(chunk_lines(all_lines)):
+            # Chunks with nothing business-related (comment banners, file specs) aren't worth a model call
+            if KEYWORD_PREFILTER and len({m.upper() for m in _KEYWORD_RE.findall(chunk)}) < KEYWORD_MIN_HITS:
+                print(f"⏭️ Skipping chunk {i+1}/{total}: no business-logic keywords")
+                skipped.append(i + 1)
+                continue
+            yield i, build_prompt(template, chunk, None, program)
+    
+    # Chunks are built as the queue has room and run through the model concurrently;
+    # results are handled in chunk order so numbering stays sequential
+    asyncio.run(generate_all(prompts(), total, handle, concurrency))
+    
+    for md_future, docx_future, filename, low_confidence in pending_saves:
+        md_error = md_future.exception()
+        docx_saved = docx_future.result()
+        if md_error is not None:
+            print(f"❌ Could not write markdown for {filename}: {md_error}"
+                  + ("" if docx_saved else " (Word doc failed too)"))
+        elif low_confidence:
+            print(f"⚠️ Created low confidence use case: {filename}" + ("" if docx_saved else " (Word doc failed)"))
+        elif docx_saved:
+            print(f"✅ Created use case: {filename}")
+        else:
+            print(f"⚠️ Created use case markdown but Word doc failed: {filename}")
+    io_pool.shutdown(wait=True)
+    
     # Write aggregated outputs
     print(f"Writing summary files...")
     
@@ -330,15 +745,15 @@ def process_chunks(file_path, program):
     # Summary as Word document - create with better error handling
     try:
         if unique_results:
-            doc = Document()
+            paragraphs = []
             for r in unique_results:
-                doc.add_paragraph("=" * 60)
+                paragraphs.append(_para(_run("=" * 60)))
                 for line in format_narrative(r).splitlines():
                     if line.startswith("### "):
-                        doc.add_heading(line[4:], level=2)
+                        paragraphs.append(_para(_run(line[4:]), "Heading2"))
                     else:
-                        doc.add_paragraph(line)
-            doc.save(summary_docx)
+                        paragraphs.append(_para(_run(line)))
+            _write_docx(summary_docx, paragraphs)
     except Exception as e:
         print(f"Error creating summary document: {e}")
     
@@ -346,10 +761,22 @@ def process_chunks(file_path, program):
     with open(failed_txt, "w") as f:
         for idx in failed:
             f.write(f"Chunk {idx} failed\n")
+        for idx in skipped:
+            f.write(f"Chunk {idx} skipped (no business-logic keywords)\n")
     
-    print(f"✅ Done: {len(unique_results)} use cases ({use_case_counter-1} total including low confidence), {len(failed)} failed chunks.")
+    print(f"✅ Done: {len(unique_results)} use cases ({use_case_counter-1} total including low confidence), "
+          f"{len(failed)} failed chunks, {len(skipped)} skipped.")
     return len(unique_results), use_case_counter-1, len(failed)
 
+def _process_one(job):
+    """Worker entry point for run_all; a file that errors counts as nothing processed"""
+    path, program, concurrency = job
+    try:
+        return process_chunks(path, program, concurrency)
+    except Exception as e:
+        print(f"❌ Error processing {path}: {e}")
+        return 0, 0, 0
+
 def run_all():
     total_success = 0
     total_all = 0
@@ -357,9 +784,12 @@ def run_all():
     
     print(f"Starting batch processing of {len(ALL_RPG_FILES)} files...")
     
+    # Each file worker gets an equal share of the server's slots
+    per_file = max(1, OLLAMA_CONCURRENCY // FILE_WORKERS)
+    jobs = []
     for fname in ALL_RPG_FILES:
         full_path = os.path.join(SOURCE_DIR, fname)
-        program_match = re.search(r"AP(\d+)", fname.upper())
+        program_match = _PROGRAM_RE.search(fname.upper())
         
         if not program_match:
             print(f"Skipping {fname}: No AP### match.")
@@ -370,12 +800,14 @@ def run_all():
             continue
             
         program_num = program_match.group(1)
-        print(f"\n{'=' * 60}\nProcessing file: {fname} (AP{program_num})\n{'=' * 60}")
-        
-        success, all_count, failed = process_chunks(full_path, program_num)
-        total_success += success
-        total_all += all_count
-        total_failed += failed
+        print(f"\n{'=' * 60}\nQueued file: {fname} (AP{program_num})\n{'=' * 60}")
+        jobs.append((full_path, program_num, per_file))
+    
+    with ProcessPoolExecutor(max_workers=FILE_WORKERS) as pool:
+        for success, all_count, failed in pool.map(_process_one, jobs):
+            total_success += success
+            total_all += all_count
+            total_failed += failed
     
     print(f"\n{'=' * 60}")
     print(f"BATCH PROCESSING COMPLETE")
@@ -386,14 +818,14 @@ def run_all():
 
 if __name__ == "__main__":
     # Create output directories if they don't exist
-    os.makedirs(OUTPUT_BASE, exist_ok=True)
-    os.makedirs("logs", exist_ok=True)
+    ensure_dir(OUTPUT_BASE)
+    ensure_dir("logs")
     
     if "--all" in sys.argv:
         run_all()
     elif len(sys.argv) >= 2:
         file_arg = sys.argv[1]
-        program_match = re.search(r"AP(\d+)", file_arg.upper())
+        program_match = _PROGRAM_RE.search(file_arg.upper())
         if not program_match:
             print("❌ Invalid file name. Must include AP###.")
             sys.exit(1)
@@ -1,7 +1,75 @@
 import os
+import re
 import docx
-import shutil
+import zipfile
 from pathlib import Path
+from xml.sax.saxutils import escape
+
+# Parts of the package that hold document text
+TEXT_PARTS = re.compile(r"word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml")
+
+def strip_text_from_parts(doc_path, text_to_remove):
+    """
+    Remove text_to_remove straight from the package's XML bytes, leaving runs and formatting alone.
+    Returns (parts, changes_made), or None when a match might be split across runs and the
+    paragraph-level edit has to be used instead. Only the text parts are read unless something changes.
+    """
+    needle = escape(text_to_remove).encode("utf-8")
+    # A run ending in the start of the text may continue it in the next run
+    split_ends = [needle[:i] + b"</w:t>" for i in range(1, len(needle))]
+    
+    with zipfile.ZipFile(doc_path) as zf:
+        infos = zf.infolist()
+        cleaned = {}
+        for info in infos:
+            if not TEXT_PARTS.fullmatch(info.filename):
+                continue
+            data = zf.read(info)
+            if needle in data:
+                data = cleaned[info.filename] = data.replace(needle, b"")
+            if any(end in data for end in split_ends):
+                return None
+        
+        if not cleaned:
+            return [], False
+        parts = [(info, cleaned[info.filename] if info.filename in cleaned else zf.read(info)) for info in infos]
+    return parts, True
+
+def write_parts(parts, destination_path):
+    with zipfile.ZipFile(destination_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for info, data in parts:
+            zf.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+
+def clean_with_python_docx(doc_path, destination_path, text_to_remove):
+    """Paragraph-level removal; catches text split across runs but rewrites those paragraphs' runs"""
+    # Open the original; the destination is only written if something is removed
+    doc = docx.Document(doc_path)
+    
+    # Flag to track if changes were made
+    changes_made = False
+    
+    # Process each paragraph in the document
+    for paragraph in doc.paragraphs:
+        if text_to_remove in paragraph.text:
+            # Replace the text in the paragraph
+            new_text = paragraph.text.replace(text_to_remove, "")
+            paragraph.text = new_text
+            changes_made = True
+    
+    # Process text in tables
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for paragraph in cell.paragraphs:
+                    if text_to_remove in paragraph.text:
+                        new_text = paragraph.text.replace(text_to_remove, "")
+                        paragraph.text = new_text
+                        changes_made = True
+    
+    # Save the document if changes were made
+    if changes_made:
+        doc.save(destination_path)
+    return changes_made
 
 def clean_word_documents(source_folder, destination_folder, text_to_remove):
     """
@@ -31,39 +99,19 @@ def clean_word_documents(source_folder, destination_folder, text_to_remove):
         print(f"Processing: {file_name}")
         
         try:
-            # First copy the original file to the destination
-            shutil.copy2(doc_path, destination_path)
-            
-            # Open the copied document
-            doc = docx.Document(destination_path)
-            
-            # Flag to track if changes were made
-            changes_made = False
-            
-            # Process each paragraph in the document
-            for paragraph in doc.paragraphs:
-                if text_to_remove in paragraph.text:
-                    # Replace the text in the paragraph
-                    new_text = paragraph.text.replace(text_to_remove, "")
-                    paragraph.text = new_text
-                    changes_made = True
-            
-            # Process text in tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        for paragraph in cell.paragraphs:
-                            if text_to_remove in paragraph.text:
-                                new_text = paragraph.text.replace(text_to_remove, "")
-                                paragraph.text = new_text
-                                changes_made = True
+            stripped = strip_text_from_parts(doc_path, text_to_remove)
+            if stripped is None:
+                changes_made = clean_with_python_docx(doc_path, destination_path, text_to_remove)
+            else:
+                parts, changes_made = stripped
+                if changes_made:
+                    write_parts(parts, destination_path)
             
-            # Save the document if changes were made
             if changes_made:
-                doc.save(destination_path)
                 print(f"  - Saved edited copy with changes to: {destination_path}")
             else:
-                print(f"  - No instances of '{text_to_remove}' found in document")
+                # Nothing to remove, so the document isn't copied at all
+                print(f"  - No instances of '{text_to_remove}' found in document, skipped")
                 
         except Exception as e:
             print(f"Error processing file {file_name}: {str(e)}")